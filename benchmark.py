@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+import wheelcode
+
+
+# The system as seen by the actions being measured.
+MODEL = {
+    'files': {
+        '/etc/php/7.2/apache2/php.ini': '',
+        '/etc/php/7.2/cli/php.ini': '',
+        '/etc/php/7.2/fpm/php.ini': '',
+    },
+    'commands': [
+        (r'^ls /etc/php/', 0, '/etc/php/7.2/apache2/php.ini\n'
+                              '/etc/php/7.2/cli/php.ini\n'
+                              '/etc/php/7.2/fpm/php.ini\n'),
+        (r'SHOW DATABASES', 0, 'phabricator_config\n'
+                               'phabricator_file\n'
+                               'phabricator_repository\n'
+                               'phabricator_user\n'),
+        (r'SELECT @@GLOBAL\.', 0, '1\n'),
+        (r'xargs -0 -r chown', 0, '1\n0\n0\n0\n'),
+    ],
+}
+
+# Size of every backup file restored.
+BACKUP_FILE_SIZE = 64 * 1024
+
+# The number of processes a shell accessing a container would
+# spawn for a kind of plan entry, when not using a session.
+SPAWNS = {'run': 1, 'session': 1, 'exchange': 0, 'exists': 1,
+          'read': 1, 'write': 1, 'copy': 1}
+
+# Values of the baseline that are compared exactly.
+COUNTERS = ['commands', 'spawns', 'round_trips', 'bytes', 'log_writes']
+
+
+# Counts log writes per step and otherwise discards them.
+class CountingLogger(wheelcode.Logger):
+    def __init__(self):
+        super().__init__()
+        self.counts = dict()
+
+    def _write(self, stream, output):
+        pass
+
+    def _count(self):
+        step, task = self.get_context()
+        self.counts[step] = self.counts.get(step, 0) + 1
+
+    def log_task(self, task):
+        super().log_task(task)
+        self._count()
+
+    def log_shell_command(self, command):
+        super().log_shell_command(command)
+        self._count()
+
+    def log_shell_stdout(self, output):
+        super().log_shell_stdout(output)
+        self._count()
+
+    def log_shell_stderr(self, output):
+        super().log_shell_stderr(output)
+        self._count()
+
+
+def prepare_backup(dir):
+    databases_dir = os.path.join(dir, 'databases')
+    os.makedirs(databases_dir)
+    paths = [os.path.join(dir, 'data.tar.zst')]
+    for database in ['config', 'file', 'repository', 'user']:
+        paths.append(os.path.join(databases_dir,
+                                  'phabricator_%s.sql.zst' % database))
+
+    for path in paths:
+        with open(path, 'wb') as f:
+            f.write(bytes(BACKUP_FILE_SIZE))
+
+
+ACTIONS = {
+    'install': (None, lambda phabricator, dir: phabricator.install()),
+    'backup': (None,
+               lambda phabricator, dir: phabricator.backup(dir, jobs=4)),
+    'restore': (prepare_backup,
+                lambda phabricator, dir: phabricator.restore(dir, jobs=4)),
+    'restart': (None, lambda phabricator, dir: phabricator.restart()),
+}
+
+
+# Runs an action against a recording shell. Returns the time it
+# took and the resulting plan and log counts.
+def run_action(id, latency):
+    prepare, action = ACTIONS[id]
+    log = CountingLogger()
+    shell = wheelcode.RecordingShell(log, MODEL, latency=latency)
+    phabricator = wheelcode.MyDockerPhabricator(
+        container_name='phabricator',
+        mysql_config=wheelcode.Config(),
+        app_config=wheelcode.Config(),
+        shell=shell)
+
+    with tempfile.TemporaryDirectory() as dir:
+        if prepare:
+            prepare(dir)
+
+        start = time.monotonic()
+        action(phabricator, dir)
+        shell.close()
+        elapsed = time.monotonic() - start
+
+    return elapsed, shell.get_plan(), log.counts
+
+
+def new_stats():
+    return {'commands': 0, 'spawns': 0, 'round_trips': 0, 'bytes': 0,
+            'log_writes': 0, 'simulated_time': 0.0}
+
+
+# Steps outside of task graphs are attributed to the action
+# itself. Steps named after local files are named after their
+# base names, as the directory is temporary.
+def get_step_id(step):
+    if not step:
+        return '-'
+    if step.startswith('/'):
+        return os.path.basename(step)
+    return step
+
+
+def measure(id, latency):
+    overhead, plan, counts = run_action(id, 0)
+    wall_time, _, _ = run_action(id, latency)
+
+    steps = dict()
+    for entry in plan:
+        stats = steps.setdefault(get_step_id(entry['step']), new_stats())
+        if entry['type'] == 'run':
+            stats['commands'] += 1
+        stats['spawns'] += SPAWNS[entry['type']]
+        stats['round_trips'] += 1
+        stats['bytes'] += (entry.get('input_size', 0) +
+                           entry.get('output_size', 0))
+        stats['simulated_time'] += latency
+
+    for step, count in counts.items():
+        stats = steps.setdefault(get_step_id(step), new_stats())
+        stats['log_writes'] += count
+
+    total = new_stats()
+    for stats in steps.values():
+        for key in total:
+            total[key] += stats[key]
+
+    total['overhead'] = overhead
+    total['wall_time'] = wall_time
+    return {'total': total, 'steps': steps}
+
+
+def print_results(results):
+    row = '%-36s %8s %8s %8s %10s %8s %10s'
+    print(row % ('step', 'commands', 'spawns', 'trips', 'bytes', 'log',
+                 'simulated'))
+    for id, result in results.items():
+        total = result['total']
+        print('%s: overhead %.3fs, wall time %.3fs' % (
+                  id, total['overhead'], total['wall_time']))
+        for step, stats in sorted(result['steps'].items()):
+            print(row % ('  ' + step, stats['commands'], stats['spawns'],
+                         stats['round_trips'], stats['bytes'],
+                         stats['log_writes'],
+                         '%.3fs' % stats['simulated_time']))
+        print(row % ('  total', total['commands'], total['spawns'],
+                     total['round_trips'], total['bytes'],
+                     total['log_writes'],
+                     '%.3fs' % total['simulated_time']))
+
+
+# Counters are expected to match the baseline exactly, as they do
+# not depend on the machine. Times are only reported.
+def compare(results, baseline):
+    regressions = []
+    for id, result in results.items():
+        if id not in baseline:
+            continue
+
+        for key in COUNTERS:
+            old = baseline[id]['total'][key]
+            new = result['total'][key]
+            if new != old:
+                print('%s: %s changed from %s to %s.' % (id, key, old, new))
+            if new > old:
+                regressions.append((id, key))
+
+        old = baseline[id]['total']['overhead']
+        new = result['total']['overhead']
+        if old:
+            print('%s: overhead is %.2f of the baseline.' % (id, new / old))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='benchmark.py')
+    parser.add_argument('--latency', metavar='MS', type=float, default=10,
+                        help='simulated latency of every round trip to '
+                             'the container, in milliseconds')
+    parser.add_argument('--baseline', metavar='FILE',
+                        default=os.path.join(os.path.dirname(__file__),
+                                             'benchmark-baseline.json'),
+                        help='compare results with the baseline in FILE')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='store the results as the new baseline')
+    parser.add_argument('actions', nargs='*',
+                        help='actions to measure, of %s; all by default' % (
+                                 ', '.join(ACTIONS)))
+    args = parser.parse_args()
+
+    for id in args.actions:
+        if id not in ACTIONS:
+            parser.error('unknown action %s' % repr(id))
+
+    results = dict()
+    for id in args.actions or ACTIONS:
+        results[id] = measure(id, args.latency / 1000)
+    print_results(results)
+
+    if args.save_baseline:
+        with open(args.baseline, 'wt') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+            f.write('\n')
+        return
+
+    try:
+        with open(args.baseline, 'rt') as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        return
+
+    if compare(results, baseline):
+        sys.exit('Regressions found.')
+
+
+if __name__ == '__main__':
+    main()
@@ -8,6 +8,17 @@ if [ ! "$(docker network ls | grep phabricator_net)" ]; then
         phabricator_net
 fi
 
+BASE_IMAGE=ubuntu_supervisor:18.04
+
+# Start from the most recent image wheelcode has cached with system
+# packages installed, unless the image is given explicitly.
+if [ -z "${IMAGE}" ]; then
+    IMAGE=$(docker image ls \
+                --filter "label=wheelcode.base-image=${BASE_IMAGE}" \
+                --format '{{.Repository}}:{{.Tag}}' \
+                wheelcode-base | awk 'NR == 1')
+fi
+
 docker run \
     --detach \
     --interactive \
@@ -16,4 +27,4 @@ docker run \
     --publish 80:80 \
     --network=phabricator_net \
     --restart unless-stopped \
-    ubuntu_supervisor:18.04
+    ${IMAGE:-${BASE_IMAGE}}
@@ -21,7 +21,7 @@ setuptools.setup(
     #         'tproc = tproc:main',
     #     ],
     # },
-    # test_suite='tests',
+    test_suite='tests',
     classifiers=[
         'Development Status :: 3 - Alpha',
         'Environment :: Console',
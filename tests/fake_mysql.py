@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+
+import sqlite3
+import sys
+
+
+# A stand-in for the MySQL client in the batch mode, backed by an
+# in-memory SQLite database. Like 'mysql --batch --force', it reads
+# statements, one per line, prints tab-separated rows of results,
+# and reports errors with the numbers of the input lines they come
+# from. Command-line options are ignored.
+def main():
+    database = sqlite3.connect(':memory:', isolation_level=None)
+    for number, line in enumerate(iter(sys.stdin.readline, ''), 1):
+        statement = line.strip().rstrip(';')
+        if not statement:
+            continue
+
+        try:
+            rows = database.execute(statement).fetchall()
+        except sqlite3.Error as e:
+            print('ERROR 1064 (42000) at line %d: %s' % (number, e))
+        else:
+            for row in rows:
+                print('\t'.join(str(value) for value in row))
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+import grp
+import io
+import os
+import pwd
+import tempfile
+
+import wheelcode
+
+
+# Tests every shell backend shall pass. Test cases mixing this in
+# provide the transport by implementing open_shell(), which returns
+# a shell whose target is the local machine, close_transport(),
+# get_connections() and get_expected_target_id(). The
+# reused_connections attribute is the number of connections five
+# commands and five file checks are expected to take.
+class ShellContract(object):
+    reused_connections = 1
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.root = os.path.join(self.dir.name, 'root')
+        self.owner = '%s:%s' % (pwd.getpwuid(os.getuid()).pw_name,
+                                grp.getgrgid(os.getgid()).gr_name)
+
+        self.sink = wheelcode.TraceSink()
+        self.writer = wheelcode.LogWriter(echo=False)
+        self.log = wheelcode.Logger(self.sink, self.writer)
+        self.shell = self.open_shell()
+
+    def tearDown(self):
+        self.shell.close()
+        self.close_transport()
+        self.writer.close()
+        self.dir.cleanup()
+
+    def get_spans(self, name):
+        return [span for span in self.sink.get_spans()
+                if span['name'] == name]
+
+    def test_run(self):
+        self.assertEqual(self.shell.run(['echo', 'a;', 'echo', 'b', '>&2']),
+                         (0, 'a\n'))
+        self.assertEqual(self.shell.run('cat', input=b'data'), (0, 'data'))
+
+        output = io.BytesIO()
+        self.shell.run(['head', '-c', '300000', '/dev/zero'], output=output)
+        self.assertEqual(len(output.getvalue()), 300000)
+
+        self.assertEqual(self.shell.run(['exit', '3'], may_fail=True),
+                         (3, ''))
+
+    def test_run_failure_quotes_output(self):
+        with self.assertRaises(wheelcode.Error) as context:
+            self.shell.run(['echo', 'broken;', 'exit', '1'])
+        self.assertIn('broken', str(context.exception))
+
+    def test_does_file_exist(self):
+        self.assertTrue(self.shell.does_file_exist(self.dir.name))
+        self.assertFalse(self.shell.does_file_exist(self.root))
+
+    def test_write_and_read_files(self):
+        a = os.path.join(self.root, 'a', 'a.txt')
+        b = os.path.join(self.root, 'b.txt')
+        files = [(a, b'a', self.owner, 0o640),
+                 (b, b'b' * 100000, self.owner, 0o600)]
+        self.assertEqual(self.shell.write_files(files), [a, b])
+        self.assertEqual(self.shell.write_files(files), [])
+        self.assertEqual(os.stat(a).st_mode & 0o777, 0o640)
+
+        read = self.shell.read_files([a, b, os.path.join(self.root, 'c')])
+        self.assertEqual(read, {a: (b'a', self.owner, 0o640),
+                                b: (b'b' * 100000, self.owner, 0o600)})
+        self.assertEqual(self.shell.read_file(a), b'a')
+
+    # A failed write leaves the manifest as it was, so that the
+    # write is retried.
+    def test_failed_write_is_retried(self):
+        os.makedirs(self.root)
+        blocker = os.path.join(self.root, 'a')
+        with open(blocker, 'wb'):
+            pass
+
+        path = os.path.join(blocker, 'f')
+        with self.assertRaises(wheelcode.Error):
+            self.shell.write_file(path, b'f', owner=self.owner)
+
+        os.remove(blocker)
+        self.assertTrue(self.shell.write_file(path, b'f', owner=self.owner))
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'f')
+
+    def test_copy_dir(self):
+        source = os.path.join(self.dir.name, 'source')
+        os.makedirs(os.path.join(source, 'sub'))
+        with open(os.path.join(source, 'sub', 'f'), 'wb') as f:
+            f.write(b'f')
+
+        os.makedirs(self.root)
+        target = os.path.join(self.root, 'copy')
+        self.shell.copy_dir(source, target)
+        with open(os.path.join(target, 'sub', 'f'), 'rb') as f:
+            self.assertEqual(f.read(), b'f')
+
+    def test_connections_are_reused(self):
+        for i in range(5):
+            self.shell.run(['true'])
+            self.shell.does_file_exist(self.dir.name)
+        self.assertEqual(self.get_connections(), self.reused_connections)
+
+    def test_get_target_id(self):
+        self.assertEqual(self.shell.get_target_id(),
+                         self.get_expected_target_id())
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+
+import asyncio
+import io
+import os
+import tempfile
+import time
+import unittest
+
+import wheelcode
+
+
+# Stands in for the Docker CLI by running commands given to
+# 'docker exec' locally. Like 'docker exec', it reports commands
+# killed by signals with statuses above 128.
+_FAKE_DOCKER = '''#!/bin/sh
+[ "$1" = exec ] || exit 1
+shift
+[ "$1" = --interactive ] && shift
+shift
+"$@"
+'''
+
+
+def _is_running(pid):
+    try:
+        with open('/proc/%d/stat' % pid) as f:
+            state = f.read().rsplit(')', 1)[1].split()[0]
+    except FileNotFoundError:
+        return False
+    return state != 'Z'
+
+
+class _AsyncShellTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.sink = wheelcode.TraceSink()
+        self.writer = wheelcode.LogWriter(echo=False)
+        self.log = wheelcode.Logger(self.sink, self.writer)
+        self.shell = wheelcode.AsyncLocalShell(self.log)
+        self.shell._kill_delay = 1
+
+    def tearDown(self):
+        self.writer.close()
+        self.dir.cleanup()
+
+    def get_path(self, name):
+        return os.path.join(self.dir.name, name)
+
+    # Returns the ID of the process that wrote it to the file.
+    async def get_pid(self, name):
+        path = self.get_path(name)
+        while not os.path.exists(path) or not os.path.getsize(path):
+            await asyncio.sleep(0.01)
+        with open(path) as f:
+            return int(f.read())
+
+    def get_statuses(self, name):
+        return [span['status'] for span in self.sink.get_spans()
+                if span['name'] == name]
+
+
+class TestAsyncLocalShell(_AsyncShellTestCase):
+    async def test_run(self):
+        self.assertEqual(await self.shell.run(['echo', 'a']), (0, 'a\n'))
+        self.assertEqual(await self.shell.run(['cat'], input=b'data'),
+                         (0, 'data'))
+
+        output = io.BytesIO()
+        await self.shell.run(['head', '-c', '300000', '/dev/zero'],
+                             output=output)
+        self.assertEqual(len(output.getvalue()), 300000)
+
+        self.assertEqual(await self.shell.run(['false'], may_fail=True),
+                         (1, ''))
+
+    async def test_deadline(self):
+        command = ['sh', '-c', 'echo $$ >%s; exec sleep 30' % (
+                       self.get_path('pid'))]
+        start = time.monotonic()
+        with self.assertRaises(wheelcode.Error) as context:
+            await self.shell.run(command, timeout=0.5)
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertIn('timed out', str(context.exception))
+
+        self.assertFalse(_is_running(await self.get_pid('pid')))
+        self.assertEqual(self.get_statuses(' '.join(command)), [-15])
+
+    # Commands ignoring SIGTERM are killed, along with the rest of
+    # their process group, so that no process keeps the pipes open.
+    async def test_deadline_kills_process_group(self):
+        command = ['sh', '-c', "trap '' TERM; sleep 30 & echo $! >%s; "
+                   "wait" % self.get_path('pid')]
+        start = time.monotonic()
+        with self.assertRaises(wheelcode.Error):
+            await self.shell.run(command, timeout=0.5)
+        self.assertLess(time.monotonic() - start, 5)
+
+        self.assertFalse(_is_running(await self.get_pid('pid')))
+        self.assertEqual(self.get_statuses(' '.join(command)), [-9])
+
+    async def test_cancellation_stops_command(self):
+        task = asyncio.ensure_future(self.shell.run(
+            ['sh', '-c', 'echo $$ >%s; exec sleep 30' % (
+                 self.get_path('pid'))]))
+        pid = await self.get_pid('pid')
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+        self.assertFalse(_is_running(pid))
+
+    # Errors of commands running concurrently in different tasks
+    # quote only the output of their own commands.
+    async def test_output_tails_are_per_task(self):
+        async def fail(name):
+            await self.shell.run(['sh', '-c', 'echo %s; sleep 0.2; '
+                                  'echo %s; exit 1' % (name, name)])
+
+        results = await asyncio.gather(fail('first'), fail('second'),
+                                       return_exceptions=True)
+        for name, error in zip(['first', 'second'], results):
+            self.assertIsInstance(error, wheelcode.Error)
+            message = str(error)
+            self.assertEqual(message.count(name), 2)
+            self.assertNotIn({'first': 'second',
+                              'second': 'first'}[name], message)
+
+
+class TestAsyncDockerContainerShell(_AsyncShellTestCase):
+    def setUp(self):
+        super().setUp()
+        docker = self.get_path('docker')
+        with open(docker, 'w') as f:
+            f.write(_FAKE_DOCKER)
+        os.chmod(docker, 0o755)
+        self.path = os.environ['PATH']
+        os.environ['PATH'] = '%s:%s' % (self.dir.name, self.path)
+
+        self.container = wheelcode.AsyncDockerContainerShell('test',
+                                                             self.shell)
+
+    def tearDown(self):
+        os.environ['PATH'] = self.path
+        super().tearDown()
+
+    async def test_run(self):
+        self.assertEqual(await self.container.run(['echo', 'a;', 'echo',
+                                                   'b', '>&2']),
+                         (0, 'a\n'))
+        self.assertEqual(await self.container.run('cat', input=b'data'),
+                         (0, 'data'))
+
+    # The deadline is enforced by timeout(1) in the container.
+    async def test_deadline(self):
+        start = time.monotonic()
+        with self.assertRaises(wheelcode.Error) as context:
+            await self.container.run(['sleep', '30'], timeout=1)
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertIn('timed out', str(context.exception))
+
+    async def test_deadline_kills_command(self):
+        start = time.monotonic()
+        with self.assertRaises(wheelcode.Error) as context:
+            await self.container.run(["trap '' TERM; sleep 30"], timeout=1)
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertIn('timed out', str(context.exception))
+
+    async def test_write_and_read_files(self):
+        path = self.get_path('a/a.txt')
+        status, owner = await self.container.run(['stat', '-c', '%U:%G',
+                                                  self.dir.name])
+        owner = owner.strip()
+        self.assertTrue(await self.container.write_file(path, b'a',
+                                                        owner=owner))
+        self.assertFalse(await self.container.write_file(path, b'a',
+                                                         owner=owner))
+        self.assertEqual(await self.container.read_file(path), b'a')
+
+
+if __name__ == '__main__':
+    unittest.main()
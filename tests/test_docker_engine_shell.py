@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+
+import http.server
+import io
+import json
+import os
+import socketserver
+import subprocess
+import tarfile
+import threading
+import unittest
+import urllib.parse
+
+import wheelcode
+from tests.shell_contract import ShellContract
+
+
+# A stand-in for the Docker Engine API serving a single container,
+# which is the local machine. Commands of exec instances run as
+# local processes and archives are extracted to the local file
+# system.
+class _FakeEngineHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def _reply(self, status, content=None):
+        body = b'' if content is None else json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    # Returns the path components following the API version and
+    # the query, or None if a missing container was replied to.
+    def _parse_path(self):
+        url = urllib.parse.urlsplit(self.path)
+        parts = url.path.split('/')[2:]
+        query = urllib.parse.parse_qs(url.query)
+        if parts[0] == 'containers' and parts[1] != self.server.container:
+            self._reply(404, {'message': 'No such container: %s' % parts[1]})
+            return None, None
+        return parts, query
+
+    def do_HEAD(self):
+        parts, query = self._parse_path()
+        if parts:
+            self._reply(200 if os.path.exists(query['path'][0]) else 404)
+
+    def do_GET(self):
+        parts, query = self._parse_path()
+        if not parts:
+            return
+
+        if parts[0] == 'containers':
+            self._reply(200, {'Id': 'fake-%s' % self.server.container})
+        else:
+            self._reply(200, {'ExitCode': self.server.execs[parts[1]]['code']})
+
+    def do_PUT(self):
+        parts, query = self._parse_path()
+        if not parts:
+            return
+
+        try:
+            with tarfile.open(fileobj=io.BytesIO(self._read_body())) as tar:
+                tar.extractall(query['path'][0])
+        except OSError as e:
+            self._reply(500, {'message': str(e)})
+            return
+        self._reply(200)
+
+    def do_POST(self):
+        parts, query = self._parse_path()
+        if not parts:
+            return
+
+        if parts[0] == 'containers':
+            with self.server.lock:
+                id = str(len(self.server.execs) + 1)
+                self.server.execs[id] = json.loads(self._read_body())
+            self._reply(201, {'Id': id})
+            return
+
+        self._read_body()
+        instance = self.server.execs[parts[1]]
+        self.send_response(101)
+        self.send_header('Connection', 'Upgrade')
+        self.send_header('Upgrade', 'tcp')
+        self.end_headers()
+        self.wfile.flush()
+        self.close_connection = True
+
+        process = subprocess.Popen(
+            instance['Cmd'],
+            stdin=(subprocess.PIPE if instance['AttachStdin']
+                   else subprocess.DEVNULL),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        lock = threading.Lock()
+
+        def pump(file, stream):
+            for chunk in iter(lambda: file.read1(64 * 1024), b''):
+                with lock:
+                    self.wfile.write(bytes([stream, 0, 0, 0]) +
+                                     len(chunk).to_bytes(4, 'big') + chunk)
+                    self.wfile.flush()
+
+        def feed():
+            for chunk in iter(lambda: self.rfile.read1(64 * 1024), b''):
+                process.stdin.write(chunk)
+            process.stdin.close()
+
+        with process:
+            threads = [
+                threading.Thread(target=pump, args=(process.stdout, 1)),
+                threading.Thread(target=pump, args=(process.stderr, 2))]
+            if instance['AttachStdin']:
+                threads.append(threading.Thread(target=feed, daemon=True))
+            for thread in threads:
+                thread.start()
+            for thread in threads[:2]:
+                thread.join()
+            instance['code'] = process.wait()
+
+
+class _FakeEngine(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, container):
+        super().__init__(path, _FakeEngineHandler)
+        self.container = container
+        self.execs = dict()
+        self.connections = 0
+        self.lock = threading.Lock()
+
+
+# Exec instances are started on connections of their own, but all
+# other requests go through one pooled connection.
+class TestDockerEngineShell(ShellContract, unittest.TestCase):
+    reused_connections = 5 + 1
+
+    def open_shell(self):
+        self.socket_path = os.path.join(self.dir.name, 'docker.sock')
+        self.engine = _FakeEngine(self.socket_path, 'test')
+        threading.Thread(target=self.engine.serve_forever,
+                         daemon=True).start()
+        return wheelcode.DockerEngineShell('test', self.log,
+                                           socket_path=self.socket_path)
+
+    def close_transport(self):
+        self.engine.shutdown()
+        self.engine.server_close()
+
+    def get_connections(self):
+        return self.engine.connections
+
+    def get_expected_target_id(self):
+        return 'docker:fake-test'
+
+    def test_does_file_exist_in_missing_container(self):
+        shell = wheelcode.DockerEngineShell('missing', self.log,
+                                            socket_path=self.socket_path)
+        with self.assertRaises(wheelcode.Error):
+            shell.does_file_exist(self.root)
+        shell.close()
+
+    def test_uploads_end_command_spans(self):
+        self.log.log_step('step')
+        self.shell.write_file(os.path.join(self.root, 'f'), b'f',
+                              owner=self.owner)
+        self.log.log_step_end()
+
+        puts = [span for span in self.sink.get_spans()
+                if span['name'].startswith('PUT')]
+        self.assertEqual([span['status'] for span in puts], [0])
+
+
+if __name__ == '__main__':
+    unittest.main()
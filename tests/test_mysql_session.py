@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import unittest
+
+import wheelcode
+
+
+class TestMySQLSession(unittest.TestCase):
+    def setUp(self):
+        self.writer = wheelcode.LogWriter(echo=False)
+        self.log = wheelcode.Logger(writer=self.writer)
+        client = os.path.join(os.path.dirname(__file__), 'fake_mysql.py')
+        self.session = wheelcode.MySQLSession(
+            wheelcode.LocalShell(self.log),
+            '%s %s' % (sys.executable, client))
+
+    def tearDown(self):
+        self.session.close()
+        self.writer.close()
+
+    def test_batch(self):
+        self.session.execute('CREATE TABLE t (a)')
+        self.session.execute('INSERT INTO t VALUES (1), (2)')
+        self.session.execute('SELECT a FROM t\nORDER BY a')
+        self.assertEqual(self.session.flush(), '1\n2')
+        self.assertEqual(self.session.flush(), '')
+
+    # Errors are attributed to statements by the line numbers the
+    # client reports, which count from the start of the session.
+    def test_error_is_attributed_to_statement(self):
+        self.session.execute('CREATE TABLE t (a)')
+        self.session.execute('INSERT INTO t VALUES (1)')
+        self.session.flush()
+
+        self.session.execute('INSERT INTO t VALUES (2)')
+        self.session.execute('INSERT INTO missing VALUES (3)')
+        self.session.execute('SELECT a FROM t')
+        with self.assertRaises(wheelcode.Error) as context:
+            self.session.flush()
+
+        message = str(context.exception)
+        self.assertIn('no such table: missing\n'
+                      '    INSERT INTO missing VALUES (3);', message)
+        self.assertNotIn('VALUES (2)', message)
+        self.assertNotIn('SELECT', message)
+
+    def test_every_failed_statement_is_reported(self):
+        self.session.execute('SELECT * FROM first')
+        self.session.execute('SELECT 1')
+        self.session.execute('SELECT * FROM second')
+        with self.assertRaises(wheelcode.Error) as context:
+            self.session.flush()
+
+        failures = str(context.exception).splitlines()[1:]
+        self.assertEqual(failures, [
+            'ERROR 1064: no such table: first',
+            '    SELECT * FROM first;',
+            'ERROR 1064: no such table: second',
+            '    SELECT * FROM second;'])
+
+    # Statements following failed ones still run.
+    def test_may_fail(self):
+        self.session.execute('SELECT * FROM missing')
+        self.session.execute('SELECT 1')
+        self.assertEqual(self.session.flush(may_fail=True), '1')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+
+import os
+import pwd
+import socket
+import subprocess
+import threading
+import unittest
+
+import wheelcode
+from tests.shell_contract import ShellContract
+
+paramiko = wheelcode.paramiko
+
+
+# Serves files of the local file system, to the extent the shell
+# uses SFTP.
+if paramiko:
+    class _FakeSFTPHandle(paramiko.SFTPHandle):
+        def stat(self):
+            return paramiko.SFTPAttributes.from_stat(
+                os.fstat(self.writefile.fileno()))
+
+    class _FakeSFTPServer(paramiko.SFTPServerInterface):
+        def stat(self, path):
+            try:
+                return paramiko.SFTPAttributes.from_stat(os.stat(path))
+            except OSError as e:
+                return paramiko.SFTPServer.convert_errno(e.errno)
+
+        lstat = stat
+
+        def mkdir(self, path, attr):
+            mode = 0o777 if attr.st_mode is None else attr.st_mode
+            try:
+                os.mkdir(path, mode)
+            except OSError as e:
+                return paramiko.SFTPServer.convert_errno(e.errno)
+            return paramiko.SFTP_OK
+
+        def open(self, path, flags, attr):
+            try:
+                fd = os.open(path, flags, 0o600)
+            except OSError as e:
+                return paramiko.SFTPServer.convert_errno(e.errno)
+            handle = _FakeSFTPHandle(flags)
+            handle.readfile = handle.writefile = os.fdopen(fd, 'r+b')
+            return handle
+
+    # A stand-in for sshd that runs commands as local processes
+    # and accepts a single client key.
+    class _FakeServer(paramiko.ServerInterface):
+        def __init__(self, client_key):
+            self._client_key = client_key
+
+        def get_allowed_auths(self, username):
+            return 'publickey'
+
+        def check_auth_publickey(self, username, key):
+            if key == self._client_key:
+                return paramiko.AUTH_SUCCESSFUL
+            return paramiko.AUTH_FAILED
+
+        def check_channel_request(self, kind, chanid):
+            return paramiko.OPEN_SUCCEEDED
+
+        def check_channel_exec_request(self, channel, command):
+            threading.Thread(target=_run_command, args=(channel, command),
+                             daemon=True).start()
+            return True
+
+
+def _run_command(channel, command):
+    process = subprocess.Popen(['sh', '-c', command], stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def feed():
+        for chunk in iter(lambda: channel.recv(64 * 1024), b''):
+            process.stdin.write(chunk)
+            process.stdin.flush()
+        process.stdin.close()
+
+    def pump_stderr():
+        for chunk in iter(lambda: process.stderr.read1(64 * 1024), b''):
+            channel.sendall_stderr(chunk)
+
+    with process:
+        threading.Thread(target=feed, daemon=True).start()
+        stderr_pump = threading.Thread(target=pump_stderr)
+        stderr_pump.start()
+        for chunk in iter(lambda: process.stdout.read1(64 * 1024), b''):
+            channel.sendall(chunk)
+        stderr_pump.join()
+        channel.send_exit_status(process.wait())
+    channel.shutdown_write()
+    channel.close()
+
+
+# Commands, SFTP transfers and sessions are all channels of a
+# single connection.
+@unittest.skipIf(paramiko is None, 'paramiko is not installed')
+class TestRemoteShell(ShellContract, unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.host_key = paramiko.RSAKey.generate(2048)
+        cls.client_key = paramiko.RSAKey.generate(2048)
+
+    def _serve(self):
+        while True:
+            try:
+                conn, address = self.listener.accept()
+            except OSError:
+                break
+            self.connections += 1
+            transport = paramiko.Transport(conn)
+            transport.add_server_key(self.host_key)
+            transport.set_subsystem_handler('sftp', paramiko.SFTPServer,
+                                            _FakeSFTPServer)
+            transport.start_server(server=_FakeServer(self.client_key))
+            self.transports.append(transport)
+
+    def open_shell(self):
+        self.listener = socket.socket()
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen()
+        port = self.listener.getsockname()[1]
+        self.connections = 0
+        self.transports = []
+        threading.Thread(target=self._serve, daemon=True).start()
+
+        known_hosts = os.path.join(self.dir.name, 'known_hosts')
+        with open(known_hosts, 'w') as f:
+            f.write('[127.0.0.1]:%d %s %s\n' % (
+                port, self.host_key.get_name(), self.host_key.get_base64()))
+        key_filename = os.path.join(self.dir.name, 'id_rsa')
+        self.client_key.write_private_key_file(key_filename)
+
+        return wheelcode.RemoteShell(
+            '127.0.0.1', self.log, port=port,
+            username=pwd.getpwuid(os.getuid()).pw_name,
+            key_filename=key_filename, known_hosts=known_hosts)
+
+    def close_transport(self):
+        self.listener.close()
+        for transport in self.transports:
+            transport.close()
+
+    def get_connections(self):
+        return self.connections
+
+    def get_expected_target_id(self):
+        return 'ssh:127.0.0.1:%s' % self.host_key.get_fingerprint().hex()
+
+    # The staging directory is removed even if installing fails.
+    def test_write_files_removes_staging_directory(self):
+        def get_staging():
+            return {name for name in os.listdir('/tmp')
+                    if name.startswith('wheelcode-')}
+
+        before = get_staging()
+        os.makedirs(self.root)
+        with open(os.path.join(self.root, 'file'), 'wb'):
+            pass
+        with self.assertRaises(wheelcode.Error):
+            self.shell.write_file(os.path.join(self.root, 'file', 'f'),
+                                  b'f', owner=self.owner)
+        self.assertEqual(get_staging(), before)
+
+    def test_session(self):
+        session = self.shell.open_session('sh')
+        sentinel = session.new_sentinel()
+        request = 'echo a; echo b >&2; echo "%s $?"; echo "%s" >&2\n' % (
+            sentinel, sentinel)
+        self.assertEqual(session.exchange(request, sentinel),
+                         (b'a\n', b'b\n', '0'))
+        session.close()
+
+        spans = self.get_spans('ssh 127.0.0.1 sh')
+        self.assertEqual([span['status'] for span in spans], [0])
+
+    def test_transfers_share_connection(self):
+        self.shell.write_file(os.path.join(self.root, 'f'), b'f',
+                              owner=self.owner)
+        self.shell.read_file(os.path.join(self.root, 'f'))
+        self.assertEqual(self.get_connections(), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+import unittest
+
+import wheelcode
+
+
+class TestShellSession(unittest.TestCase):
+    def setUp(self):
+        self.sink = wheelcode.TraceSink()
+        self.writer = wheelcode.LogWriter(echo=False)
+        self.log = wheelcode.Logger(self.sink, self.writer)
+
+    def tearDown(self):
+        self.writer.close()
+
+    def _start(self, command):
+        self.log.log_shell_command(command)
+        return wheelcode.ShellSession(command, self.log)
+
+    def _get_span(self, name):
+        spans = [span for span in self.sink.get_spans()
+                 if span['name'] == name]
+        self.assertEqual(len(spans), 1)
+        return spans[0]
+
+    def test_exchange(self):
+        session = self._start(['sh'])
+        sentinel = session.new_sentinel()
+        request = 'echo a; echo b >&2; echo "%s $?"; echo "%s" >&2\n' % (
+            sentinel, sentinel)
+        self.assertEqual(session.exchange(request, sentinel),
+                         (b'a\n', b'b\n', '0'))
+        session.close()
+
+    # The session command keeps running while other commands are
+    # logged and its span is ended with its status on closing.
+    def test_session_status_is_logged_on_close(self):
+        self.log.log_step('step')
+        session = self._start(['sh'])
+        self.log.log_shell_command(['true'])
+        self.log.log_shell_status(0)
+        self.assertNotIn('sh', [span['name']
+                                for span in self.sink.get_spans()])
+
+        session.close()
+        self.assertEqual(self._get_span('sh')['status'], 0)
+        self.log.log_step_end()
+
+    def test_terminated_session_status(self):
+        session = self._start(['sh', '-c', 'exit 3'])
+        sentinel = session.new_sentinel()
+        with self.assertRaises(wheelcode.Error):
+            session.exchange('echo "%s 0"\n' % sentinel, sentinel)
+        session.close()
+        self.assertEqual(self._get_span('sh -c exit 3')['status'], 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
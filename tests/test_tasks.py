@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+import wheelcode
+
+
+class _TasksTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.log_path = os.path.join(self.dir.name, 'log')
+        self.writer = wheelcode.LogWriter(self.log_path, echo=False)
+        self.log = wheelcode.Logger(writer=self.writer)
+        self.events = []
+        self.lock = threading.Lock()
+
+    def tearDown(self):
+        self.writer.close()
+        self.dir.cleanup()
+
+    def add_event(self, event):
+        with self.lock:
+            self.events.append(event)
+
+    # Returns a step function that logs and records its start and
+    # end, taking the given time in between.
+    def get_step(self, id, delay=0, error=None):
+        def step():
+            self.add_event(('start', id))
+            self.log('Run %s.' % id)
+            time.sleep(delay)
+            if error:
+                raise error
+            self.add_event(('end', id))
+        return step
+
+    def get_run_ids(self):
+        return [id for event, id in self.events if event == 'start']
+
+    def read_log(self):
+        self.writer.close()
+        with open(self.log_path, 'rb') as f:
+            return f.read().decode('utf-8')
+
+
+class TestTasks(_TasksTestCase):
+    def test_dependencies_run_first(self):
+        tasks = wheelcode.Tasks(self.log, jobs=4)
+        tasks.add('a', self.get_step('a', delay=0.1))
+        tasks.add('b', self.get_step('b'), deps=['a'])
+        tasks.add('c', self.get_step('c', delay=0.1))
+        tasks.add('d', self.get_step('d'), deps=['b', 'c'])
+        tasks.run()
+
+        def index(event, id):
+            return self.events.index((event, id))
+
+        self.assertLess(index('end', 'a'), index('start', 'b'))
+        self.assertLess(index('end', 'b'), index('start', 'd'))
+        self.assertLess(index('end', 'c'), index('start', 'd'))
+
+    def test_independent_steps_run_concurrently(self):
+        barrier = threading.Barrier(2, timeout=5)
+        tasks = wheelcode.Tasks(self.log, jobs=2)
+        tasks.add('a', barrier.wait)
+        tasks.add('b', barrier.wait)
+        tasks.run()
+
+    def test_jobs_limit(self):
+        running = [0, 0]
+
+        def step():
+            with self.lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.05)
+            with self.lock:
+                running[0] -= 1
+
+        tasks = wheelcode.Tasks(self.log, jobs=2)
+        for id in 'abcde':
+            tasks.add(id, step)
+        tasks.run()
+        self.assertEqual(running[1], 2)
+
+    def test_failure_stops_dependents(self):
+        error = wheelcode.Error('a failed')
+        tasks = wheelcode.Tasks(self.log, jobs=4)
+        tasks.add('a', self.get_step('a', error=error))
+        tasks.add('b', self.get_step('b'), deps=['a'])
+        tasks.add('c', self.get_step('c'), deps=['b'])
+        with self.assertRaises(wheelcode.Error) as context:
+            tasks.run()
+        self.assertIs(context.exception, error)
+        self.assertEqual(self.get_run_ids(), ['a'])
+
+    # Output of concurrent steps is written in the order the steps
+    # were added, including that of failed steps.
+    def test_output_is_replayed_in_order(self):
+        tasks = wheelcode.Tasks(self.log, jobs=4)
+        tasks.add('a', self.get_step('a', delay=0.2))
+        tasks.add('b', self.get_step('b'))
+        tasks.add('c', self.get_step('c', delay=0.1,
+                                     error=wheelcode.Error('c failed')))
+        with self.assertRaises(wheelcode.Error):
+            tasks.run()
+
+        self.assertLess(self.events.index(('end', 'b')),
+                        self.events.index(('end', 'a')))
+        self.assertEqual(self.read_log(),
+                         '# Run a.\n# Run b.\n# Run c.\n')
+
+    def test_selected_steps(self):
+        tasks = wheelcode.Tasks(self.log)
+        tasks.add('a', self.get_step('a'))
+        tasks.add('b', self.get_step('b'), deps=['a'])
+        tasks.add('c', self.get_step('c'))
+        tasks.run(['b'])
+        self.assertEqual(self.get_run_ids(), ['b'])
+
+    def test_get_dependents(self):
+        tasks = wheelcode.Tasks(self.log)
+        tasks.add('a', None)
+        tasks.add('b', None, deps=['a'])
+        tasks.add('c', None)
+        tasks.add('d', None, deps=['b'])
+        self.assertEqual(tasks.get_dependents(['a']), ['a', 'b', 'd'])
+
+    def test_invalid_steps(self):
+        tasks = wheelcode.Tasks(self.log)
+        tasks.add('a', None)
+        with self.assertRaises(wheelcode.Error):
+            tasks.add('a', None)
+        with self.assertRaises(wheelcode.Error):
+            tasks.add('b', None, deps=['c'])
+
+
+class TestStepJournal(_TasksTestCase):
+    def setUp(self):
+        super().setUp()
+        self.journal_path = os.path.join(self.dir.name, 'journal')
+
+    # Runs steps a, b depending on a, and c, with a new journal
+    # loaded from the file every time, as on a new run.
+    def run_steps(self, a_inputs=None, b_error=None):
+        journal = wheelcode.StepJournal(self.journal_path)
+        tasks = wheelcode.Tasks(self.log, journal=journal)
+        tasks.add('a', self.get_step('a'), inputs=a_inputs)
+        tasks.add('b', self.get_step('b', error=b_error), deps=['a'])
+        tasks.add('c', self.get_step('c'))
+
+        del self.events[:]
+        tasks.run()
+        return sorted(self.get_run_ids())
+
+    def test_journaled_steps_are_skipped(self):
+        self.assertEqual(self.run_steps(), ['a', 'b', 'c'])
+        self.assertEqual(self.run_steps(), [])
+
+    def test_changed_inputs_rerun_step_and_dependents(self):
+        self.run_steps(a_inputs=1)
+        self.assertEqual(self.run_steps(a_inputs=2), ['a', 'b'])
+        self.assertEqual(self.run_steps(a_inputs=2), [])
+
+    def test_resume_at_failed_step(self):
+        with self.assertRaises(wheelcode.Error):
+            self.run_steps(b_error=wheelcode.Error('b failed'))
+        self.assertEqual(self.run_steps(), ['b'])
+
+    def test_steps_are_forgotten_for_other_target(self):
+        journal = wheelcode.StepJournal(self.journal_path)
+        self.assertFalse(journal.set_target('first'))
+        journal.record('a', 'key')
+
+        journal = wheelcode.StepJournal(self.journal_path)
+        self.assertFalse(journal.set_target('first'))
+        self.assertTrue(journal.is_done('a', 'key'))
+        self.assertFalse(journal.is_done('a', 'other key'))
+
+        self.assertTrue(journal.set_target('second'))
+        self.assertFalse(journal.is_done('a', 'key'))
+
+
+if __name__ == '__main__':
+    unittest.main()
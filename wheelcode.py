@@ -1,12 +1,39 @@
 #!/usr/bin/env python3
 
+import argparse
+import asyncio
+import base64
+import concurrent.futures
+import contextvars
+import functools
+import hashlib
+import http.client
+import io
+import json
 import os
 import posixpath
+import queue
+import re
 import subprocess
 import secrets
+import shlex
+import selectors
+import shutil
+import signal
+import socket
 import string
 import sys
+import tarfile
 import tempfile
+import threading
+import time
+import urllib.parse
+
+# Only needed to access hosts over SSH.
+try:
+    import paramiko
+except ImportError:
+    paramiko = None
 
 
 class Error(Exception):
@@ -22,18 +49,48 @@ def _identical(*args):
     return args[0]
 
 
+def _do_nothing():
+    pass
+
+
+def _get_user_command(command, user):
+    return ['sudo', '--non-interactive', '--login',
+            '--user', user, '--'] + command
+
+
+# Makes a command running the given commands as a pipeline that
+# fails if any of them fails. sh has no pipefail option, so the
+# pipeline is run with bash.
+def _get_pipeline_command(*commands):
+    pipeline = ' | '.join(' '.join(command) for command in commands)
+    return ['bash', '-o', 'pipefail', '-c', shlex.quote(pipeline)]
+
+
+# Makes the error for a failed shell command, quoting the tail of
+# its output as kept by the logger.
+def _get_command_error(log, status):
+    message = 'Shell command returned %d.' % status
+    tail = log.get_output_tail().decode('utf-8', errors='replace')
+    if tail.strip():
+        message += '\nLast output:\n%s' % tail.rstrip('\n')
+    return Error(message)
+
+
 def generate_password():
     alphabet = string.ascii_letters + string.digits
     return ''.join(secrets.choice(alphabet) for i in range(16))
 
 
-# Stores configuration values.
+# Stores configuration values. Values last applied to the system
+# are tracked separately, so that changes can be found.
 class Config(object):
     def __init__(self, options=dict()):
         self._options = dict()
         for id, value in options.items():
             self[id] = value
 
+        self._applied = dict()
+
     def __contains__(self, id):
         return id in self._options
 
@@ -58,111 +115,766 @@ class Config(object):
         for id in sorted(self._options):
             yield (id, self._options[id])
 
-    def load(self, path):
+    def _read(self, path):
         with open(path, 'rt') as f:
-            for id, value in eval(f.read()).items():
-                self[id] = value
+            return eval(f.read())
 
-    def save(self, path):
+    def _write(self, path, options):
         tmp_path = path + '.tmp'
         with open(tmp_path, 'wt') as f:
             f.write('{\n')
-            for id, value in self:
+            for id, value in sorted(options.items()):
                 f.write('    %s: %s,\n' % (repr(id), repr(value)))
             f.write('}\n')
         os.rename(tmp_path, path)
 
+    def load(self, path):
+        for id, value in self._read(path).items():
+            self[id] = value
+
+    def save(self, path):
+        self._write(path, self._options)
+
+    def load_applied(self, path):
+        self._applied = self._read(path)
+
+    def save_applied(self, path):
+        self._write(path, self._applied)
+
+    def mark_applied(self):
+        self._applied = dict(self._options)
+
+    # Returns None for options never applied.
+    def get_applied(self, id):
+        return self._applied.get(id)
+
+    # Returns options whose values differ from the applied ones,
+    # mapped to (applied, current) pairs. Options missing on either
+    # side have None as their values.
+    def get_diff(self):
+        diff = dict()
+        for id in set(self._options) | set(self._applied):
+            if (id not in self._options or id not in self._applied or
+                    self._options[id] != self._applied[id]):
+                diff[id] = (self._applied.get(id), self._options.get(id))
+        return diff
+
+
+# Writes log output on a background thread, so that logging does
+# not wait for the terminal. Output is flushed once complete lines
+# are written, or after a short pause for incomplete ones. With a
+# path specified, the output is also appended to a log file, which
+# is rotated once it grows over the given size. Unless echoing is
+# on, the output only goes to the file. Streams and files that fail
+# to be written to, e.g., a closed pipe, are no longer written to,
+# but the rest of the output still goes to the others.
+class LogWriter(object):
+    _flush_delay = 0.1
+
+    def __init__(self, path=None, max_size=16 * 1024 * 1024, backups=3,
+                 echo=True):
+        self._path = path
+        self._max_size = max_size
+        self._backups = backups
+        self._echo = echo
+
+        self._file = None
+        if path:
+            self._file = open(path, 'ab')
+
+        self._failed = set()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._write_records,
+                                        daemon=True)
+        self._thread.start()
+
+    def write(self, stream, output):
+        self._queue.put((stream, output))
+
+    def _rotate(self):
+        self._file.close()
+        for i in range(self._backups - 1, 0, -1):
+            path = '%s.%d' % (self._path, i)
+            if os.path.exists(path):
+                os.replace(path, '%s.%d' % (self._path, i + 1))
+        if self._backups:
+            os.replace(self._path, self._path + '.1')
+        self._file = open(self._path, 'wb')
+
+    def _write_to_file(self, output):
+        if self._file.tell() + len(output) > self._max_size:
+            self._rotate()
+        self._file.write(output)
+
+    # Calls the function unless writing to the target has failed
+    # before. Returns whether the call succeeded.
+    def _try(self, target, func, *args):
+        if target in self._failed:
+            return False
+
+        try:
+            func(*args)
+        except (OSError, ValueError):
+            self._failed.add(target)
+            return False
+        return True
+
+    def _write_records(self):
+        unflushed = set()
+        done = False
+        while not done:
+            try:
+                records = [self._queue.get(timeout=self._flush_delay)]
+            except queue.Empty:
+                records = []
+
+            # Take everything queued so far.
+            while True:
+                try:
+                    records.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
 
-# A customizable logger.
+            lines = set()
+            for record in records:
+                if record is None:
+                    done = True
+                    continue
+
+                stream, output = record
+                if isinstance(output, str):
+                    stream = stream.buffer
+                    output = output.encode('utf-8')
+
+                if self._echo and self._try(stream, stream.write, output):
+                    unflushed.add(stream)
+                    if b'\n' in output:
+                        lines.add(stream)
+                if self._file:
+                    self._try('file', self._write_to_file, output)
+
+            # Incomplete lines are flushed when nothing more comes.
+            for stream in list(unflushed):
+                if stream in lines or not records or done:
+                    self._try(stream, stream.flush)
+                    unflushed.remove(stream)
+
+            if self._file and (lines or not records or done):
+                self._try('file', self._file.flush)
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        if self._file:
+            self._file.close()
+
+
+# Collects timing spans of steps, tasks and shell commands
+# reported by a logger.
+class TraceSink(object):
+    def __init__(self):
+        self._start = time.monotonic()
+        self._spans = []
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def get_time(self):
+        return time.monotonic() - self._start
+
+    def new_span_id(self):
+        with self._lock:
+            self._count += 1
+            return self._count
+
+    def add_span(self, span):
+        with self._lock:
+            self._spans.append(span)
+
+    def get_spans(self):
+        with self._lock:
+            return sorted(self._spans, key=lambda span: span['start'])
+
+    def save_json_lines(self, path):
+        with open(path, 'wt') as f:
+            for span in self.get_spans():
+                f.write(json.dumps(span, sort_keys=True) + '\n')
+
+    # Saves spans in the Chrome trace event format, as understood
+    # by chrome://tracing and Perfetto.
+    def save_chrome_trace(self, path):
+        threads = dict()
+        events = []
+        for span in self.get_spans():
+            tid = threads.setdefault(span['thread'], len(threads) + 1)
+            args = {'id': span['id'], 'parent': span['parent'],
+                    'bytes': span['bytes']}
+            if 'status' in span:
+                args['status'] = span['status']
+            events.append({'name': span['name'], 'cat': span['kind'],
+                           'ph': 'X', 'pid': 1, 'tid': tid,
+                           'ts': round(span['start'] * 1e6),
+                           'dur': round((span['end'] - span['start']) * 1e6),
+                           'args': args})
+
+        with open(path, 'wt') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+    # Files with the .jsonl extension get JSON lines.
+    def save(self, path):
+        if path.endswith('.jsonl'):
+            self.save_json_lines(path)
+        else:
+            self.save_chrome_trace(path)
+
+
+# A customizable logger. With a trace sink specified, it also
+# records nested spans of steps, tasks and shell commands. A step
+# or task span ends when its step ends or a span of the same or
+# higher level starts in the same thread. A command span ends when
+# the command reports the status, its step ends, or another command
+# starts in the same context.
+#
+# Output is written directly to the standard streams, unless a
+# LogWriter is given. The last tail_size bytes of output of the
+# current command are kept, so that errors can quote them.
+#
+# Steps and tasks are tracked per thread, and commands per context,
+# so that commands running concurrently on an event loop, each in
+# its own asyncio task, have their own output tails and spans.
 class Logger(object):
+    _span_levels = {'step': 0, 'task': 1}
+
+    def __init__(self, sink=None, writer=None, tail_size=4 * 1024):
+        self._local = threading.local()
+        self._command = contextvars.ContextVar('command', default=None)
+        self._sink = sink
+        self._writer = writer
+        self._tail_size = tail_size
+
+    def _get_spans(self):
+        spans = getattr(self._local, 'spans', None)
+        if spans is None:
+            spans = self._local.spans = []
+        return spans
+
+    def _new_span(self, kind, name):
+        spans = self._get_spans()
+        return {'id': self._sink.new_span_id(),
+                'parent': spans[-1]['id'] if spans else None,
+                'kind': kind, 'name': name,
+                'thread': threading.get_ident(),
+                'start': self._sink.get_time(), 'bytes': 0}
+
+    def _end_span(self, span):
+        span['end'] = self._sink.get_time()
+        self._sink.add_span(span)
+
+    def _open_span(self, kind, name):
+        self._close_spans(kind)
+        self._get_spans().append(self._new_span(kind, name))
+
+    def _close_spans(self, kind):
+        if kind == 'step':
+            self._close_command_span()
+
+        spans = self._get_spans()
+        level = self._span_levels[kind]
+        while spans and self._span_levels[spans[-1]['kind']] >= level:
+            self._end_span(spans.pop())
+
+    def _close_command_span(self):
+        command = self._command.get()
+        if command and command['span']:
+            self._end_span(command['span'])
+            command['span'] = None
+
+    def _count_output(self, output):
+        command = self._command.get()
+        if command and command['span']:
+            command['span']['bytes'] += len(output)
+
     def _write(self, stream, output):
         if output:
+            records = getattr(self._local, 'records', None)
+            if records is not None:
+                records.append((stream, output))
+                return
+
+            if self._writer:
+                self._writer.write(stream, output)
+                return
+
             stream.write(output)
             stream.flush()
 
+    # Makes the output of the current thread to be collected
+    # instead of being written out.
+    def capture(self):
+        self._local.records = []
+
+    def release(self):
+        records = self._local.records
+        self._local.records = None
+        return records
+
+    def replay(self, records):
+        for stream, output in records:
+            self._write(stream, output)
+
     def _write_stdout(self, output):
         self._write(sys.stdout.buffer, output)
 
     def _write_stderr(self, output):
         self._write(sys.stderr.buffer, output)
 
+    # Called when a step of a task graph starts running in the
+    # current thread.
+    def log_step(self, id):
+        self._local.step = id
+        self._local.task = None
+        if self._sink:
+            self._open_span('step', id)
+
+    def log_step_end(self):
+        self._local.step = None
+        self._local.task = None
+        if self._sink:
+            self._close_spans('step')
+
+    # Ends spans still open in the current thread, e.g., before
+    # saving the trace.
+    def end_spans(self):
+        if self._sink:
+            self._close_spans('step')
+
     def log_task(self, task):
+        self._local.task = task
+        if self._sink:
+            self._open_span('task', task)
         self._write(sys.stdout, '# %s\n' % task)
 
+    # Reports progress of the current command. Unlike tasks, it
+    # opens no span, so the span of the command is not ended.
+    def log_progress(self, message):
+        self._write(sys.stdout, '# %s\n' % message)
+
+    # Returns the step and task the current thread is running.
+    def get_context(self):
+        return (getattr(self._local, 'step', None),
+                getattr(self._local, 'task', None))
+
     def __call__(self, task):
         self.log_task(task)
 
+    def _add_to_tail(self, output):
+        command = self._command.get()
+        if not command:
+            return
+
+        tail = command['tail']
+        tail += output
+        if len(tail) > self._tail_size:
+            del tail[:len(tail) - self._tail_size]
+
+    # Returns the last output of the current command.
+    def get_output_tail(self):
+        command = self._command.get()
+        return bytes(command['tail']) if command else b''
+
     def log_shell_command(self, command):
+        span = None
+        if self._sink:
+            self._close_command_span()
+            span = self._new_span('command', ' '.join(command))
+        self._command.set({'tail': bytearray(), 'span': span})
         self._write(sys.stdout, '$ %s\n' % ' '.join(command))
 
+    # Called when the last logged command completes. The size is
+    # that of the output that did not go through the log.
+    def log_shell_status(self, status, size=0):
+        command = self._command.get()
+        if command and command['span']:
+            command['span']['status'] = status
+            command['span']['bytes'] += size
+            self._close_command_span()
+
+    # Takes the last logged command out of the current context, so
+    # that it keeps running alongside the commands that follow, as
+    # shell sessions do. Returns the command to be passed to
+    # log_detached_status() once it completes.
+    def detach_shell_command(self):
+        command = self._command.get()
+        self._command.set(None)
+        return command
+
+    def log_detached_status(self, command, status):
+        if command and command['span']:
+            command['span']['status'] = status
+            self._end_span(command['span'])
+            command['span'] = None
+
     def log_shell_stdout(self, output):
+        if self._sink:
+            self._count_output(output)
+        if self._tail_size:
+            self._add_to_tail(output)
         self._write_stdout(output)
 
     def log_shell_stderr(self, output):
+        if self._sink:
+            self._count_output(output)
+        if self._tail_size:
+            self._add_to_tail(output)
         self._write_stderr(output)
 
 
 # Provides access to local shell.
 class LocalShell(object):
+    # Size of chunks we read process output in.
+    _CHUNK_SIZE = 64 * 1024
+
     def __init__(self, log):
         self.log = log
 
-    def run(self, command, may_fail=False):
+    def _pump(self, process, input, output):
+        write_stdout = output.write if output else self.log.log_shell_stdout
+        selector = selectors.DefaultSelector()
+        selector.register(process.stdout, selectors.EVENT_READ, write_stdout)
+        selector.register(process.stderr, selectors.EVENT_READ,
+                          self.log.log_shell_stderr)
+
+        if input is not None:
+            if isinstance(input, bytes):
+                input = io.BytesIO(input)
+
+            os.set_blocking(process.stdin.fileno(), False)
+            selector.register(process.stdin, selectors.EVENT_WRITE,
+                              memoryview(b''))
+
+        stdout = []
+        size = 0
+        while selector.get_map():
+            for key, events in selector.select():
+                if key.fileobj is process.stdin:
+                    data = key.data or memoryview(
+                        input.read(self._CHUNK_SIZE))
+                    try:
+                        written = os.write(key.fd, data) if data else None
+                    except BrokenPipeError:
+                        written = None
+
+                    if written is None:
+                        selector.unregister(key.fileobj)
+                        process.stdin.close()
+                    else:
+                        selector.modify(key.fileobj, selectors.EVENT_WRITE,
+                                        data[written:])
+                    continue
+
+                chunk = os.read(key.fd, self._CHUNK_SIZE)
+                if not chunk:
+                    selector.unregister(key.fileobj)
+                    continue
+
+                key.data(chunk)
+                if key.fileobj is process.stdout:
+                    size += len(chunk)
+                    if not output:
+                        stdout.append(chunk)
+
+        selector.close()
+        return b''.join(stdout), size
+
+    # The input is either bytes or a file object to read from.
+    # Unless the output file is given, the stdout data is logged
+    # and returned.
+    def run(self, command, may_fail=False, binary=False, input=None,
+            output=None):
         if not isinstance(command, list):
             command = command.split()
 
         self.log.log_shell_command(command)
-        process = subprocess.Popen(command, bufsize=1,
+        process = subprocess.Popen(command, bufsize=0,
+                                   stdin=(None if input is None
+                                          else subprocess.PIPE),
                                    stdout=subprocess.PIPE,
                                    stderr=subprocess.PIPE)
 
-        stdout = []
-        while process.poll() is None:
-            while True:
-                chunk = process.stdout.read(1)  # TODO: .decode('ascii')
-                if not chunk:
-                    break
-
-                self.log.log_shell_stdout(chunk)
-                stdout.append(chunk)
+        with process:
+            stdout, size = self._pump(process, input, output)
+            status = process.wait()
 
-            while True:
-                chunk = process.stderr.read(1)  # TODO: .decode('ascii')
-                if not chunk:
-                    break
+        self.log.log_shell_status(status, size if output else 0)
 
-                self.log.log_shell_stderr(chunk)
-
-        # TODO: stdout = ''.join(stdout)
-        stdout = ''
-        status = process.returncode
+        if not binary:
+            stdout = stdout.decode('utf-8', errors='replace')
 
         if not may_fail and status != 0:
-            raise Error('Shell command returned %d.' % process.returncode)
+            raise _get_command_error(self.log, status)
 
         return status, stdout
 
+    # Starts a long-lived local process, e.g., a stand-in for a
+    # client that normally runs in the container.
+    def open_session(self, command):
+        command = ['sh', '-c', command]
+        self.log.log_shell_command(command)
+        return ShellSession(command, self.log)
+
+
+# Output of a session stream collected until the sentinel line.
+class _SessionStream(object):
+    def __init__(self, log_output, marker):
+        self.log_output = log_output
+        self.marker = marker
+        self.buffer = bytearray()
+        self.logged = 0
+        self.output = None
+        self.trailer = None
+
+    # Returns True when the sentinel line is complete.
+    def feed(self, chunk):
+        self.buffer.extend(chunk)
+
+        pos = self.buffer.find(self.marker,
+                               max(0, self.logged - len(self.marker)))
+        if pos < 0:
+            # Hold back what can be the beginning of the sentinel.
+            end = max(self.logged, len(self.buffer) - len(self.marker))
+            self.log_output(bytes(self.buffer[self.logged:end]))
+            self.logged = end
+            return False
+
+        self.log_output(bytes(self.buffer[self.logged:pos]))
+        self.logged = pos
+
+        end = self.buffer.find(b'\n', pos)
+        if end < 0:
+            return False
+
+        self.output = bytes(self.buffer[:pos])
+        self.trailer = bytes(self.buffer[pos + len(self.marker):end])
+        return True
+
+
+# A long-lived process receiving requests over its standard input.
+# Output of every request is terminated with a sentinel line so
+# that it can be told apart from output of other requests.
+class ShellSession(object):
+    def __init__(self, command, log):
+        self.log = log
+        self._process = subprocess.Popen(command, bufsize=0,
+                                         stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE,
+                                         stderr=subprocess.PIPE)
+        self._lock = threading.Lock()
+        self._command = log.detach_shell_command()
+
+    def new_sentinel(self):
+        return 'wheelcode-%s' % secrets.token_hex(16)
+
+    # Sends the request and reads stdout, and optionally stderr,
+    # until they contain the sentinel line. Returns the output
+    # preceding the sentinels and the rest of the stdout sentinel
+    # line.
+    def exchange(self, request, sentinel, stderr_sentinel=True):
+        marker = sentinel.encode('ascii')
+        stdout = _SessionStream(self.log.log_shell_stdout, marker)
+        stderr = _SessionStream(self.log.log_shell_stderr, marker)
+
+        with self._lock:
+            if self._process.poll() is not None:
+                raise Error('Shell session has terminated with '
+                            'status %d.' % self._process.returncode)
+
+            self._process.stdin.write(request.encode('utf-8'))
+            self._process.stdin.flush()
+
+            selector = selectors.DefaultSelector()
+            selector.register(self._process.stdout, selectors.EVENT_READ,
+                              stdout)
+            if stderr_sentinel:
+                selector.register(self._process.stderr,
+                                  selectors.EVENT_READ, stderr)
+
+            while selector.get_map():
+                for key, events in selector.select():
+                    chunk = os.read(key.fd, LocalShell._CHUNK_SIZE)
+                    if not chunk:
+                        selector.close()
+                        raise Error('Shell session has terminated '
+                                    'unexpectedly.')
+
+                    if key.data.feed(chunk):
+                        selector.unregister(key.fileobj)
+
+            selector.close()
+
+        return (stdout.output, stderr.output or b'',
+                stdout.trailer.decode('ascii').strip())
+
+    # Logs the status of the session command, which has been
+    # logged by the shell opening the session.
+    def close(self):
+        with self._lock:
+            self._process.stdin.close()
+            self._process.wait()
+            self._process.stdout.close()
+            self._process.stderr.close()
+            self.log.log_detached_status(self._command,
+                                         self._process.returncode)
+            self._command = None
+
+
+def _get_file_query_command(paths):
+    return ('for f in %s; do '
+            '[ -f "$f" ] && echo "$(sha256sum <"$f") '
+            '$(stat -c "%%U:%%G %%a %%n" "$f")"; '
+            'done; true' % ' '.join(paths))
+
+
+# Returns the (SHA-256, owner, mode) tuples of the files found by
+# the query command.
+def _parse_file_query_output(stdout):
+    states = dict()
+    for line in stdout.splitlines():
+        hash, _, owner, mode, path = line.split(maxsplit=4)
+        states[path] = hash, owner, int(mode, 8)
+    return states
+
+
+def _get_archive_command(paths):
+    return (['tar', '--create', '--file=-', '--directory=/'] +
+            [path.lstrip('/') for path in paths])
+
+
+# Returns regular files of a tar archive as a dictionary mapping
+# paths to (content, owner, mode) tuples.
+def _unpack_files(archive):
+    files = dict()
+    with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+        for info in tar:
+            if not info.isfile():
+                continue
+
+            content = tar.extractfile(info).read()
+            owner = '%s:%s' % (info.uname, info.gname)
+            files['/' + info.name] = content, owner, info.mode
+    return files
+
+
+def _get_file_states(files):
+    return {path: (hashlib.sha256(content).hexdigest(), owner, mode)
+            for path, (content, owner, mode) in files.items()}
+
+
+# Packs (path, content, owner, mode) tuples into a tar archive,
+# skipping files whose states in the manifest match. Returns the
+# archive, names of its members and the new states of the packed
+# files, which are to be put to the manifest once the archive is
+# extracted.
+def _pack_files(files, manifest):
+    archive = io.BytesIO()
+    members = []
+    states = dict()
+    with tarfile.open(fileobj=archive, mode='w') as tar:
+        for path, content, owner, mode in files:
+            state = hashlib.sha256(content).hexdigest(), owner, mode
+            if manifest.get(path) == state:
+                continue
+
+            info = tarfile.TarInfo(path.lstrip('/'))
+            info.size = len(content)
+            info.mode = mode
+            info.mtime = int(time.time())
+            info.uname, info.gname = owner.split(':')
+            tar.addfile(info, io.BytesIO(content))
+            members.append(info.name)
+            states[path] = state
 
-# Provides access to a Docker container.
+    return archive.getvalue(), members, states
+
+
+# Provides access to a Docker container. In the session mode all
+# commands are passed to a single shell process running in the
+# container, which saves us from paying for 'docker exec' on
+# every command.
 class DockerContainerShell(object):
-    def __init__(self, container_name, shell):
+    def __init__(self, container_name, shell, session=False):
         self.container_name = container_name
         self.shell = shell
         self.log = shell.log
 
-    def run(self, command, may_fail=False, user=None):
+        # Maps paths of files we have written or checked to their
+        # (SHA-256, owner, mode) tuples, so that files with the
+        # desired content and attributes are not rewritten.
+        self._manifest = dict()
+
+        self._session = None
+        if session:
+            command = ['docker', 'exec', '--interactive',
+                       self.container_name, 'sh']
+            self.log.log_shell_command(command)
+            self._session = ShellSession(command, self.log)
+
+    def _run_in_session(self, command, may_fail, binary, input):
+        # The input is passed as a here-document. Without input,
+        # make sure the command cannot read our requests.
+        sentinel = self._session.new_sentinel()
+        if input is None:
+            request = '( %s ) </dev/null\n' % ' '.join(command)
+        else:
+            request = "base64 -d <<'%s' | ( %s )\n%s%s\n" % (
+                sentinel, ' '.join(command),
+                base64.encodebytes(input).decode('ascii'), sentinel)
+
+        request += ('echo "%s $?"\n'
+                    'echo "%s" >&2\n' % (sentinel, sentinel))
+        stdout, stderr, status = self._session.exchange(request, sentinel)
+        status = int(status)
+        self.log.log_shell_status(status)
+
+        if not binary:
+            stdout = stdout.decode('utf-8', errors='replace')
+
+        if not may_fail and status != 0:
+            raise _get_command_error(self.log, status)
+
+        return status, stdout
+
+    def run(self, command, may_fail=False, user=None, binary=False,
+            input=None, output=None):
         if not isinstance(command, list):
             command = command.split()
 
         if user:
-            command = ['sudo', '--non-interactive', '--login',
-                       '--user', user, '--'] + command
-
-        command = ['docker', 'exec', '-it', self.container_name,
-                   'sh', '-c', '%s' % ' '.join(command)]
-        return self.shell.run(command, may_fail)
+            command = _get_user_command(command, user)
+
+        # Streams are not passed through sessions, so that they
+        # can be transferred concurrently.
+        if self._session and not hasattr(input, 'read') and output is None:
+            self.log.log_shell_command(command)
+            return self._run_in_session(command, may_fail, binary, input)
+
+        # Only allocate a terminal when no data is passed through
+        # the streams.
+        if input is not None:
+            options = ['--interactive']
+        elif output is not None:
+            options = []
+        else:
+            options = ['-it']
+
+        command = (['docker', 'exec'] + options + [self.container_name] +
+                   ['sh', '-c', '%s' % ' '.join(command)])
+        return self.shell.run(command, may_fail, binary=binary,
+                              input=input, output=output)
 
     def does_file_exist(self, path):
+        if self._session:
+            status, stdout = self.run(['test', '-e', path], may_fail=True)
+            return status == 0
+
         status, stdout = self.shell.run(
             ['docker', 'exec', '-it', self.container_name,
              'test', '-e', path],
@@ -171,40 +883,1473 @@ class DockerContainerShell(object):
         # self.log('Status: ' + repr(status))
         return status == 0
 
-    def write_file(self, path, content):
-        with tempfile.NamedTemporaryFile() as f:
-            f.write(content)
-            f.flush()
+    def _extract_archive(self, archive, members):
+        self.run(['tar', '--extract', '--same-owner', '--same-permissions',
+                  '--file=-', '--directory=/'] + members,
+                 binary=True, input=archive)
+
+    # Updates the manifest with the actual state of the given
+    # files in the container.
+    def _query_files(self, paths):
+        status, stdout = self.run(_get_file_query_command(paths))
+        self._manifest.update(_parse_file_query_output(stdout))
+
+    # Reads files with a single tar stream. Returns a dictionary
+    # mapping paths to (content, owner, mode) tuples. Missing files
+    # are not included.
+    def read_files(self, paths):
+        archive = io.BytesIO()
+        self.run(_get_archive_command(paths), may_fail=True, output=archive)
+        files = _unpack_files(archive.getvalue())
+        self._manifest.update(_get_file_states(files))
+        return files
+
+    def read_file(self, path):
+        files = self.read_files([path])
+        if path not in files:
+            raise Error('Cannot read file %s.' % repr(path))
+
+        content, owner, mode = files[path]
+        return content
+
+    def get_manifest(self):
+        return dict(self._manifest)
+
+    # Writes files given as (path, content, owner, mode) tuples
+    # with a single tar stream. The owner is in the 'user:group'
+    # form. Files that already have the same content, owner and
+    # mode are skipped. Returns paths of the written files.
+    def write_files(self, files):
+        unknown = [path for path, content, owner, mode in files
+                   if path not in self._manifest]
+        if unknown:
+            self._query_files(unknown)
+
+        archive, members, states = _pack_files(files, self._manifest)
+        if members:
+            self._extract_archive(archive, members)
+            self._manifest.update(states)
+
+        return ['/' + member for member in members]
+
+    # Returns whether the file has been actually written.
+    def write_file(self, path, content, owner='root:root', mode=0o644):
+        return bool(self.write_files([(path, content, owner, mode)]))
+
+    # Starts a long-lived process in the container.
+    def open_session(self, command):
+        command = ['docker', 'exec', '--interactive', self.container_name,
+                   'sh', '-c', command]
+        self.log.log_shell_command(command)
+        return ShellSession(command, self.log)
 
-            self.shell.run(
-                ['docker', 'cp', f.name,
-                 '%s:%s' % (self.container_name, path)])
+    def copy_dir(self, local_path, path):
+        self.shell.run(['docker', 'cp', local_path,
+                        '%s:%s' % (self.container_name, path)])
 
+    # Identifies the container, so that a container recreated under
+    # the same name is told apart.
+    def get_target_id(self):
+        status, stdout = self.shell.run(
+            ['docker', 'container', 'inspect', '--format', '{{.Id}}',
+             self.container_name])
+        return 'docker:%s' % stdout.strip()
 
-class Ubuntu(object):
+    def close(self):
+        if self._session:
+            self._session.close()
+            self._session = None
+
+
+# Runs local commands as asyncio subprocesses, so that many
+# commands, possibly on many containers, can be driven from a
+# single event loop without a thread per process. Both output
+# pipes are drained concurrently. Every command runs in its own
+# process group. On its deadline, the group is terminated, and
+# then killed if the command does not exit shortly, so that no
+# processes are left holding the pipes.
+class AsyncLocalShell(object):
+    _CHUNK_SIZE = LocalShell._CHUNK_SIZE
+
+    # Seconds a command is given to exit after being terminated.
+    _kill_delay = 5
+
+    def __init__(self, log):
+        self.log = log
+
+    async def _drain(self, stream, write, chunks):
+        size = 0
+        while True:
+            chunk = await stream.read(self._CHUNK_SIZE)
+            if not chunk:
+                return size
+
+            write(chunk)
+            size += len(chunk)
+            if chunks is not None:
+                chunks.append(chunk)
+
+    async def _feed(self, stdin, input):
+        if isinstance(input, bytes):
+            input = io.BytesIO(input)
+
+        try:
+            while True:
+                data = input.read(self._CHUNK_SIZE)
+                if not data:
+                    break
+                stdin.write(data)
+                await stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            stdin.close()
+
+    async def _communicate(self, process, input, output, stdout):
+        pumps = [self._drain(process.stdout,
+                             output.write if output
+                             else self.log.log_shell_stdout,
+                             None if output else stdout),
+                 self._drain(process.stderr, self.log.log_shell_stderr,
+                             None)]
+        if input is not None:
+            pumps.append(self._feed(process.stdin, input))
+
+        sizes = await asyncio.gather(*pumps)
+        status = await process.wait()
+        return status, sizes[0]
+
+    def _signal(self, process, sig):
+        try:
+            os.killpg(process.pid, sig)
+        except ProcessLookupError:
+            pass
+
+    async def _stop(self, process):
+        self._signal(process, signal.SIGTERM)
+        try:
+            await asyncio.wait_for(process.wait(), self._kill_delay)
+        except asyncio.TimeoutError:
+            self._signal(process, signal.SIGKILL)
+            await process.wait()
+
+    # Same as LocalShell.run(). The timeout is in seconds.
+    async def run(self, command, may_fail=False, binary=False, input=None,
+                  output=None, timeout=None):
+        if not isinstance(command, list):
+            command = command.split()
+
+        self.log.log_shell_command(command)
+        process = await asyncio.create_subprocess_exec(
+            *command,
+            stdin=None if input is None else asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            start_new_session=True)
+
+        stdout = []
+        try:
+            status, size = await asyncio.wait_for(
+                self._communicate(process, input, output, stdout), timeout)
+        except asyncio.TimeoutError:
+            await self._stop(process)
+            self.log.log_shell_status(process.returncode)
+            raise Error('Shell command timed out after %s seconds.' % timeout)
+        except BaseException:
+            # E.g., the calling task is cancelled.
+            await self._stop(process)
+            raise
+
+        self.log.log_shell_status(status, size if output else 0)
+
+        stdout = b''.join(stdout)
+        if not binary:
+            stdout = stdout.decode('utf-8', errors='replace')
+
+        if not may_fail and status != 0:
+            raise _get_command_error(self.log, status)
+
+        return status, stdout
+
+
+# The asyncio counterpart of DockerContainerShell, with no session
+# mode. Deadlines are also enforced in the container, as stopping
+# 'docker exec' does not stop the command it runs.
+class AsyncDockerContainerShell(object):
+    def __init__(self, container_name, shell):
+        self.container_name = container_name
+        self.shell = shell
+        self.log = shell.log
+        self._manifest = dict()
+
+    async def run(self, command, may_fail=False, user=None, binary=False,
+                  input=None, output=None, timeout=None):
+        if not isinstance(command, list):
+            command = command.split()
+
+        if user:
+            command = _get_user_command(command, user)
+
+        command = ['sh', '-c', '%s' % ' '.join(command)]
+        local_timeout = None
+        if timeout:
+            command = ['timeout', '--kill-after=%d' % self.shell._kill_delay,
+                       str(timeout)] + command
+            local_timeout = timeout + 2 * self.shell._kill_delay
+
+        # There is no terminal to pass through.
+        options = [] if input is None else ['--interactive']
+        command = (['docker', 'exec'] + options + [self.container_name] +
+                   command)
+        status, stdout = await self.shell.run(command, may_fail=True,
+                                              binary=binary, input=input,
+                                              output=output,
+                                              timeout=local_timeout)
+
+        # These are what timeout(1) returns on terminating and
+        # killing the command.
+        if timeout and status in (124, 137):
+            raise Error('Shell command timed out after %s seconds.' % timeout)
+
+        if not may_fail and status != 0:
+            raise _get_command_error(self.log, status)
+
+        return status, stdout
+
+    async def does_file_exist(self, path):
+        status, stdout = await self.run(['test', '-e', path], may_fail=True)
+        return status == 0
+
+    async def _query_files(self, paths):
+        status, stdout = await self.run(_get_file_query_command(paths))
+        self._manifest.update(_parse_file_query_output(stdout))
+
+    async def read_files(self, paths):
+        archive = io.BytesIO()
+        await self.run(_get_archive_command(paths), may_fail=True,
+                       output=archive)
+        files = _unpack_files(archive.getvalue())
+        self._manifest.update(_get_file_states(files))
+        return files
+
+    async def read_file(self, path):
+        files = await self.read_files([path])
+        if path not in files:
+            raise Error('Cannot read file %s.' % repr(path))
+
+        content, owner, mode = files[path]
+        return content
+
+    def get_manifest(self):
+        return dict(self._manifest)
+
+    async def write_files(self, files):
+        unknown = [path for path, content, owner, mode in files
+                   if path not in self._manifest]
+        if unknown:
+            await self._query_files(unknown)
+
+        archive, members, states = _pack_files(files, self._manifest)
+        if members:
+            await self.run(['tar', '--extract', '--same-owner',
+                            '--same-permissions', '--file=-',
+                            '--directory=/'] + members,
+                           binary=True, input=archive)
+            self._manifest.update(states)
+
+        return ['/' + member for member in members]
+
+    async def write_file(self, path, content, owner='root:root', mode=0o644):
+        return bool(await self.write_files([(path, content, owner, mode)]))
+
+    async def copy_dir(self, local_path, path):
+        await self.shell.run(['docker', 'cp', local_path,
+                              '%s:%s' % (self.container_name, path)])
+
+    def close(self):
+        pass
+
+
+# An HTTP connection over a unix socket.
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path):
+        super().__init__('localhost')
+        self._socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self._socket_path)
+
+
+# Provides access to a Docker container through the Docker Engine
+# API rather than the docker command, which saves starting the
+# command and connecting to the daemon for every operation. Idle
+# keep-alive connections are pooled, so that concurrent steps do
+# not share connections. Files are uploaded with the archive
+# endpoint. Sessions are still started with the docker command.
+class DockerEngineShell(object):
+    _api_prefix = '/v1.40'
+
+    def __init__(self, container_name, log,
+                 socket_path='/var/run/docker.sock'):
+        self.container_name = container_name
+        self.log = log
+        self._socket_path = socket_path
+        self._manifest = dict()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def _request(self, method, path, body=None, headers=dict(),
+                 expected=(200, 201, 204)):
+        with self._lock:
+            connection = (self._connections.pop() if self._connections
+                          else _UnixHTTPConnection(self._socket_path))
+
+        try:
+            connection.request(method, self._api_prefix + path, body=body,
+                               headers=headers)
+            response = connection.getresponse()
+            data = response.read()
+        except Exception:
+            connection.close()
+            raise
+
+        if response.will_close:
+            connection.close()
+        else:
+            with self._lock:
+                self._connections.append(connection)
+
+        if response.status not in expected:
+            raise Error('Docker Engine API request %s %s failed with %d: '
+                        '%s' % (method, path, response.status,
+                                data.decode('utf-8', errors='replace')))
+
+        return response.status, data
+
+    def _request_json(self, method, path, content=None):
+        body = None if content is None else json.dumps(content)
+        status, data = self._request(
+            method, path, body=body,
+            headers={'Content-Type': 'application/json'})
+        return json.loads(data) if data else None
+
+    def _get_archive_path(self, path):
+        return '/containers/%s/archive?path=%s' % (
+            self.container_name, urllib.parse.quote(path))
+
+    def _feed(self, sock, input):
+        if isinstance(input, bytes):
+            input = io.BytesIO(input)
+
+        try:
+            while True:
+                data = input.read(LocalShell._CHUNK_SIZE)
+                if not data:
+                    break
+                sock.sendall(data)
+            sock.shutdown(socket.SHUT_WR)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    # Starts the exec instance on a connection of its own, as the
+    # daemon takes it over for the streams. Calls the handlers
+    # with the demultiplexed stdout and stderr data.
+    def _start_exec(self, id, input, handlers):
+        body = json.dumps({'Detach': False, 'Tty': False}).encode('utf-8')
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self._socket_path)
+        try:
+            sock.sendall(('POST %s/exec/%s/start HTTP/1.1\r\n'
+                          'Host: localhost\r\n'
+                          'Content-Type: application/json\r\n'
+                          'Content-Length: %d\r\n'
+                          'Connection: Upgrade\r\n'
+                          'Upgrade: tcp\r\n'
+                          '\r\n' % (self._api_prefix, id, len(body))).encode(
+                              'ascii') + body)
+
+            stream = sock.makefile('rb')
+            status_line = stream.readline().decode('ascii', errors='replace')
+            while stream.readline() not in (b'\r\n', b''):
+                pass
+
+            status = status_line.split()[1:2]
+            if status not in (['101'], ['200']):
+                raise Error('Cannot start Docker exec instance: %s' % (
+                                status_line.strip()))
+
+            feeder = None
+            if input is not None:
+                feeder = threading.Thread(target=self._feed,
+                                          args=(sock, input))
+                feeder.start()
+
+            # Every frame is a header of the stream type and the
+            # big-endian size followed by the data.
+            while True:
+                header = stream.read(8)
+                if len(header) < 8:
+                    break
+                data = stream.read(int.from_bytes(header[4:], 'big'))
+                if header[0] in handlers:
+                    handlers[header[0]](data)
+
+            if feeder:
+                feeder.join()
+        finally:
+            sock.close()
+
+    # Same as DockerContainerShell.run().
+    def run(self, command, may_fail=False, user=None, binary=False,
+            input=None, output=None):
+        if not isinstance(command, list):
+            command = command.split()
+
+        if user:
+            command = _get_user_command(command, user)
+
+        self.log.log_shell_command(command)
+        instance = self._request_json(
+            'POST', '/containers/%s/exec' % self.container_name,
+            {'AttachStdin': input is not None, 'AttachStdout': True,
+             'AttachStderr': True, 'Tty': False,
+             'Cmd': ['sh', '-c', ' '.join(command)]})
+
+        stdout = []
+        sizes = [0]
+
+        def write_stdout(data):
+            sizes[0] += len(data)
+            if output is not None:
+                output.write(data)
+            else:
+                self.log.log_shell_stdout(data)
+                stdout.append(data)
+
+        self._start_exec(instance['Id'], input,
+                         {1: write_stdout, 2: self.log.log_shell_stderr})
+
+        status = self._request_json(
+            'GET', '/exec/%s/json' % instance['Id'])['ExitCode']
+        self.log.log_shell_status(status,
+                                  sizes[0] if output is not None else 0)
+
+        stdout = b''.join(stdout)
+        if not binary:
+            stdout = stdout.decode('utf-8', errors='replace')
+
+        if not may_fail and status != 0:
+            raise _get_command_error(self.log, status)
+
+        return status, stdout
+
+    # Responses to HEAD requests have no messages, so on 404 the
+    # container is checked to tell missing files from a missing
+    # container.
+    def does_file_exist(self, path):
+        status, data = self._request('HEAD', self._get_archive_path(path),
+                                     expected=(200, 404))
+        if status == 404:
+            self._request('GET', '/containers/%s/json' % self.container_name)
+        return status == 200
+
+    def _query_files(self, paths):
+        status, stdout = self.run(_get_file_query_command(paths))
+        self._manifest.update(_parse_file_query_output(stdout))
+
+    # Files are read with tar run in the container rather than with
+    # the archive endpoint, as the endpoint takes a single path per
+    # request and reports owners as numeric IDs, while the manifest
+    # keeps them by name.
+    def read_files(self, paths):
+        archive = io.BytesIO()
+        self.run(_get_archive_command(paths), may_fail=True, output=archive)
+        files = _unpack_files(archive.getvalue())
+        self._manifest.update(_get_file_states(files))
+        return files
+
+    def read_file(self, path):
+        files = self.read_files([path])
+        if path not in files:
+            raise Error('Cannot read file %s.' % repr(path))
+
+        content, owner, mode = files[path]
+        return content
+
+    def get_manifest(self):
+        return dict(self._manifest)
+
+    def _put_archive(self, path, archive):
+        self._request('PUT', self._get_archive_path(path), body=archive,
+                      headers={'Content-Type': 'application/x-tar'})
+
+    # The archive endpoint sets numeric owners, so files with
+    # owners other than root are then chowned by name.
+    def write_files(self, files):
+        unknown = [path for path, content, owner, mode in files
+                   if path not in self._manifest]
+        if unknown:
+            self._query_files(unknown)
+
+        archive, members, states = _pack_files(files, self._manifest)
+        if not members:
+            return []
+
+        self.log.log_shell_command(['PUT', '/'] + members)
+        self._put_archive('/', archive)
+        self.log.log_shell_status(0)
+
+        owners = dict()
+        for path, content, owner, mode in files:
+            if path.lstrip('/') in members and owner != 'root:root':
+                owners.setdefault(owner, []).append(path)
+        if owners:
+            self.run(['; '.join('chown %s %s' % (owner, ' '.join(paths))
+                                for owner, paths in sorted(owners.items()))])
+
+        self._manifest.update(states)
+        return ['/' + member for member in members]
+
+    def write_file(self, path, content, owner='root:root', mode=0o644):
+        return bool(self.write_files([(path, content, owner, mode)]))
+
+    def open_session(self, command):
+        command = ['docker', 'exec', '--interactive', self.container_name,
+                   'sh', '-c', command]
+        self.log.log_shell_command(command)
+        return ShellSession(command, self.log)
+
+    # Copies the directory as the given path, which shall not
+    # exist.
+    def copy_dir(self, local_path, path):
+        archive = io.BytesIO()
+        with tarfile.open(fileobj=archive, mode='w') as tar:
+            tar.add(local_path, arcname=posixpath.basename(path))
+
+        self.log.log_shell_command(['PUT', path])
+        self._put_archive(posixpath.dirname(path), archive.getvalue())
+        self.log.log_shell_status(0)
+
+    def get_target_id(self):
+        container = self._request_json(
+            'GET', '/containers/%s/json' % self.container_name)
+        return 'docker:%s' % container['Id']
+
+    def close(self):
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for connection in connections:
+            connection.close()
+
+
+# A long-lived process on an SSH channel. Same as ShellSession,
+# but both output streams come through the channel.
+class _ChannelSession(ShellSession):
+    def __init__(self, channel, log):
+        self.log = log
+        self._channel = channel
+        self._lock = threading.Lock()
+        self._command = log.detach_shell_command()
+
+    def exchange(self, request, sentinel, stderr_sentinel=True):
+        marker = sentinel.encode('ascii')
+        stdout = _SessionStream(self.log.log_shell_stdout, marker)
+        stderr = _SessionStream(self.log.log_shell_stderr, marker)
+        size = LocalShell._CHUNK_SIZE
+
+        with self._lock:
+            if self._channel.exit_status_ready():
+                raise Error('Shell session has terminated with '
+                            'status %d.' % self._channel.recv_exit_status())
+
+            self._channel.sendall(request.encode('utf-8'))
+
+            # Without the stderr sentinel, stderr data is only
+            # logged, so that it does not keep the channel
+            # readable.
+            selector = selectors.DefaultSelector()
+            selector.register(self._channel, selectors.EVENT_READ)
+            stdout_done = stderr_done = False
+            while not stdout_done or (stderr_sentinel and not stderr_done):
+                if not stdout_done and self._channel.recv_ready():
+                    stdout_done = stdout.feed(self._channel.recv(size))
+                elif not stderr_done and self._channel.recv_stderr_ready():
+                    chunk = self._channel.recv_stderr(size)
+                    if stderr_sentinel:
+                        stderr_done = stderr.feed(chunk)
+                    else:
+                        self.log.log_shell_stderr(chunk)
+                elif self._channel.eof_received or self._channel.closed:
+                    selector.close()
+                    raise Error('Shell session has terminated '
+                                'unexpectedly.')
+                else:
+                    selector.select()
+
+            selector.close()
+
+        return (stdout.output, stderr.output or b'',
+                stdout.trailer.decode('ascii').strip())
+
+    def close(self):
+        with self._lock:
+            if not self._channel.closed:
+                self._channel.shutdown_write()
+            self.log.log_detached_status(self._command,
+                                         self._channel.recv_exit_status())
+            self._command = None
+            self._channel.close()
+
+
+# Provides access to a host over SSH, which lets the same
+# installation steps run on bare machines as in containers. A
+# single connection is kept open and every command runs on a
+# channel of its own, so commands do not pay for connecting and
+# authenticating. Files are uploaded with SFTP over the same
+# connection. Host keys are checked against the known hosts of
+# the local user, or the given known hosts file.
+class RemoteShell(object):
+    def __init__(self, host, log, port=22, username='root',
+                 key_filename=None, known_hosts=None):
+        if paramiko is None:
+            raise Error('Accessing hosts over SSH requires paramiko; '
+                        'see create_venv.sh.')
+
+        self.host = host
+        self.log = log
+        self._manifest = dict()
+        self._sftp = None
+        self._lock = threading.Lock()
+
+        self._client = paramiko.SSHClient()
+        if known_hosts:
+            self._client.load_host_keys(known_hosts)
+        else:
+            self._client.load_system_host_keys()
+
+        try:
+            self._client.connect(host, port=port, username=username,
+                                 key_filename=key_filename)
+        except (paramiko.SSHException, OSError) as e:
+            raise Error('Cannot connect to %s: %s' % (host, e))
+
+        self._transport = self._client.get_transport()
+
+    def _open_channel(self, command):
+        try:
+            channel = self._transport.open_session()
+            channel.exec_command(command)
+        except paramiko.SSHException as e:
+            raise Error('Cannot run command on %s: %s' % (self.host, e))
+        return channel
+
+    def _get_sftp(self):
+        if not self._sftp:
+            self._sftp = self._client.open_sftp()
+        return self._sftp
+
+    def _feed(self, channel, input):
+        if isinstance(input, bytes):
+            input = io.BytesIO(input)
+
+        try:
+            while True:
+                data = input.read(LocalShell._CHUNK_SIZE)
+                if not data:
+                    break
+                channel.sendall(data)
+            channel.shutdown_write()
+        except OSError:
+            pass
+
+    # Calls the handlers with the stdout and stderr data as it
+    # arrives. Returns the exit status.
+    def _pump(self, channel, input, write_stdout, write_stderr):
+        feeder = None
+        if input is None:
+            channel.shutdown_write()
+        else:
+            feeder = threading.Thread(target=self._feed,
+                                      args=(channel, input))
+            feeder.start()
+
+        size = LocalShell._CHUNK_SIZE
+        selector = selectors.DefaultSelector()
+        selector.register(channel, selectors.EVENT_READ)
+        while True:
+            if channel.recv_ready():
+                write_stdout(channel.recv(size))
+            elif channel.recv_stderr_ready():
+                write_stderr(channel.recv_stderr(size))
+            elif channel.eof_received or channel.closed:
+                break
+            else:
+                selector.select()
+        selector.close()
+
+        if feeder:
+            feeder.join()
+
+        return channel.recv_exit_status()
+
+    # Same as DockerContainerShell.run().
+    def run(self, command, may_fail=False, user=None, binary=False,
+            input=None, output=None):
+        if not isinstance(command, list):
+            command = command.split()
+
+        if user:
+            command = _get_user_command(command, user)
+
+        self.log.log_shell_command(command)
+
+        stdout = []
+        sizes = [0]
+
+        def write_stdout(data):
+            sizes[0] += len(data)
+            if output is not None:
+                output.write(data)
+            else:
+                self.log.log_shell_stdout(data)
+                stdout.append(data)
+
+        channel = self._open_channel(' '.join(command))
+        try:
+            status = self._pump(channel, input, write_stdout,
+                                self.log.log_shell_stderr)
+        finally:
+            channel.close()
+
+        self.log.log_shell_status(status,
+                                  sizes[0] if output is not None else 0)
+
+        stdout = b''.join(stdout)
+        if not binary:
+            stdout = stdout.decode('utf-8', errors='replace')
+
+        if not may_fail and status != 0:
+            raise _get_command_error(self.log, status)
+
+        return status, stdout
+
+    def does_file_exist(self, path):
+        with self._lock:
+            try:
+                self._get_sftp().stat(path)
+            except FileNotFoundError:
+                return False
+        return True
+
+    def _query_files(self, paths):
+        status, stdout = self.run(_get_file_query_command(paths))
+        self._manifest.update(_parse_file_query_output(stdout))
+
+    def read_files(self, paths):
+        archive = io.BytesIO()
+        self.run(_get_archive_command(paths), may_fail=True, output=archive)
+        files = _unpack_files(archive.getvalue())
+        self._manifest.update(_get_file_states(files))
+        return files
+
+    def read_file(self, path):
+        files = self.read_files([path])
+        if path not in files:
+            raise Error('Cannot read file %s.' % repr(path))
+
+        content, owner, mode = files[path]
+        return content
+
+    def get_manifest(self):
+        return dict(self._manifest)
+
+    # Uploads the files that differ from the manifest to a staging
+    # directory in one SFTP batch and then installs them with a
+    # single command, which also creates missing directories and
+    # sets owners by name.
+    def write_files(self, files):
+        unknown = [path for path, content, owner, mode in files
+                   if path not in self._manifest]
+        if unknown:
+            self._query_files(unknown)
+
+        changed = []
+        for path, content, owner, mode in files:
+            state = hashlib.sha256(content).hexdigest(), owner, mode
+            if self._manifest.get(path) != state:
+                changed.append((path, content, owner, mode, state))
+        if not changed:
+            return []
+
+        staging = '/tmp/wheelcode-%s' % secrets.token_hex(8)
+        self.log.log_shell_command(['sftp', 'put', staging] +
+                                   [path for path, *rest in changed])
+        with self._lock:
+            sftp = self._get_sftp()
+            sftp.mkdir(staging, 0o700)
+            for i, (path, content, owner, mode, state) in enumerate(changed):
+                with sftp.open('%s/%d' % (staging, i), 'wb') as f:
+                    f.set_pipelined(True)
+                    f.write(content)
+
+        installs = []
+        for i, (path, content, owner, mode, state) in enumerate(changed):
+            user, group = owner.split(':')
+            installs.append('install -D -o %s -g %s -m %o %s/%d %s' % (
+                                user, group, mode, staging, i, path))
+        self.run(['set -e; trap "rm -rf %s" EXIT; %s' % (
+                      staging, '; '.join(installs))])
+
+        for path, content, owner, mode, state in changed:
+            self._manifest[path] = state
+
+        return [path for path, *rest in changed]
+
+    def write_file(self, path, content, owner='root:root', mode=0o644):
+        return bool(self.write_files([(path, content, owner, mode)]))
+
+    def open_session(self, command):
+        self.log.log_shell_command(['ssh', self.host, command])
+        return _ChannelSession(self._open_channel(command), self.log)
+
+    def _write_dir_archive(self, local_path, name, writer):
+        with tarfile.open(fileobj=writer, mode='w|') as tar:
+            tar.add(local_path, arcname=name)
+
+    # Copies the directory as the given path, which shall not
+    # exist.
+    def copy_dir(self, local_path, path):
+        pipe = _Pipe(functools.partial(self._write_dir_archive, local_path,
+                                       posixpath.basename(path)))
+        try:
+            self.run(['tar', '--extract', '--file=-',
+                      '--directory=%s' % posixpath.dirname(path)],
+                     binary=True, input=pipe.reader)
+        finally:
+            pipe.close()
+
+    # Identifies the host by its host key, which changes when the
+    # machine is reinstalled.
+    def get_target_id(self):
+        key = self._transport.get_remote_server_key()
+        return 'ssh:%s:%s' % (self.host, key.get_fingerprint().hex())
+
+    def close(self):
+        with self._lock:
+            if self._sftp:
+                self._sftp.close()
+                self._sftp = None
+        self._client.close()
+
+
+# A session of the recording shell.
+class _RecordingSession(object):
     def __init__(self, shell):
+        self.shell = shell
+        self._count = 0
+
+    def new_sentinel(self):
+        self._count += 1
+        return 'wheelcode-sentinel-%d' % self._count
+
+    def exchange(self, request, sentinel, stderr_sentinel=True):
+        request = request.replace(sentinel, '<sentinel>')
+        status, stdout = self.shell._get_result(request)
+        self.shell._record({'type': 'exchange', 'request': request,
+                            'input_size': len(request),
+                            'output_size': len(stdout)})
+        self.shell.log.log_shell_stdout(stdout)
+        return stdout, b'', str(status)
+
+    def close(self):
+        pass
+
+
+# A shell that runs nothing. Instead, it records commands, file
+# writes and queries that would be performed, and answers the
+# queries from a scripted model of the system. This lets us get
+# the full plan of an action without a container.
+#
+# The model is a dictionary with these optional fields:
+#     'files': {path: content} for files that exist.
+#     'commands': [(pattern, status, stdout)] giving the results
+#         of commands and session requests; the first pattern that
+#         re.search() finds in the command is used. Commands that
+#         match no pattern succeed with no output.
+#
+# A latency, in seconds, can be specified to simulate the time
+# every round trip to the system takes.
+class RecordingShell(object):
+    def __init__(self, log, model=dict(), latency=0):
+        self.log = log
+        self._latency = latency
+
+        self._files = dict()
+        for path, content in model.get('files', dict()).items():
+            if isinstance(content, str):
+                content = content.encode('utf-8')
+            self._files[path] = content, 'root:root', 0o644
+
+        self._commands = [(re.compile(pattern), status, stdout)
+                          for pattern, status, stdout
+                          in model.get('commands', [])]
+
+        # Like manifests of real shells, covers only files that have
+        # been read or written.
+        self._manifest = dict()
+
+        self._plan = []
+        self._lock = threading.Lock()
+
+    def _record(self, entry):
+        entry['step'], entry['task'] = self.log.get_context()
+        with self._lock:
+            self._plan.append(entry)
+
+        if self._latency:
+            time.sleep(self._latency)
+
+    def _get_result(self, command):
+        for pattern, status, stdout in self._commands:
+            if pattern.search(command):
+                if isinstance(stdout, str):
+                    stdout = stdout.encode('utf-8')
+                return status, stdout
+        return 0, b''
+
+    def run(self, command, may_fail=False, user=None, binary=False,
+            input=None, output=None):
+        if not isinstance(command, list):
+            command = command.split()
+
+        if user:
+            command = _get_user_command(command, user)
+
+        self.log.log_shell_command(command)
+        command = ' '.join(command)
+        status, stdout = self._get_result(command)
+
+        entry = {'type': 'run', 'command': command, 'status': status}
+        if isinstance(input, bytes):
+            entry['input_size'] = len(input)
+        elif input is not None:
+            entry['input_size'] = 0
+            while True:
+                data = input.read(LocalShell._CHUNK_SIZE)
+                if not data:
+                    break
+                entry['input_size'] += len(data)
+        entry['output_size'] = len(stdout)
+        self._record(entry)
+
+        if output is not None:
+            output.write(stdout)
+            self.log.log_shell_status(status, len(stdout))
+            stdout = b''
+        else:
+            self.log.log_shell_stdout(stdout)
+            self.log.log_shell_status(status)
+
+        if not binary:
+            stdout = stdout.decode('utf-8', errors='replace')
+
+        if not may_fail and status != 0:
+            raise _get_command_error(self.log, status)
+
+        return status, stdout
+
+    def does_file_exist(self, path):
+        with self._lock:
+            result = any(p == path or p.startswith(path.rstrip('/') + '/')
+                         for p in self._files)
+        self._record({'type': 'exists', 'path': path, 'result': result})
+        return result
+
+    def read_files(self, paths):
+        with self._lock:
+            files = {path: self._files[path] for path in paths
+                     if path in self._files}
+            self._manifest.update(_get_file_states(files))
+        self._record({'type': 'read', 'paths': list(paths),
+                      'output_size': sum(len(content) for content, _, _ in
+                                         files.values())})
+        return files
+
+    def read_file(self, path):
+        files = self.read_files([path])
+        if path not in files:
+            raise Error('Cannot read file %s.' % repr(path))
+
+        content, owner, mode = files[path]
+        return content
+
+    # Files written together are recorded as a single entry, the
+    # way they would be transferred.
+    def write_files(self, files):
+        written = []
+        for path, content, owner, mode in files:
+            with self._lock:
+                self._manifest.update(
+                    _get_file_states({path: (content, owner, mode)}))
+                if self._files.get(path) == (content, owner, mode):
+                    continue
+                self._files[path] = content, owner, mode
+
+            written.append({'path': path, 'owner': owner,
+                            'mode': '%o' % mode, 'size': len(content),
+                            'sha256': hashlib.sha256(content).hexdigest()})
+
+        if written:
+            self._record({'type': 'write', 'files': written,
+                          'input_size': sum(f['size'] for f in written)})
+        return [f['path'] for f in written]
+
+    def write_file(self, path, content, owner='root:root', mode=0o644):
+        return bool(self.write_files([(path, content, owner, mode)]))
+
+    def get_manifest(self):
+        with self._lock:
+            return dict(self._manifest)
+
+    def open_session(self, command):
+        self.log.log_shell_command(['sh', '-c', command])
+        self._record({'type': 'session', 'command': command})
+        return _RecordingSession(self)
+
+    def copy_dir(self, local_path, path):
+        self._record({'type': 'copy', 'local_path': local_path,
+                      'path': path})
+
+    def get_plan(self):
+        with self._lock:
+            return list(self._plan)
+
+    def get_summary(self):
+        summary = dict()
+        for entry in self.get_plan():
+            summary[entry['type']] = summary.get(entry['type'], 0) + 1
+        return summary
+
+    def save_plan(self, path):
+        with open(path, 'wt') as f:
+            json.dump({'summary': self.get_summary(),
+                       'plan': self.get_plan()},
+                      f, indent=1, sort_keys=True)
+            f.write('\n')
+
+    def close(self):
+        pass
+
+
+# Counts data read or written through a file object and reports
+# progress of the transfer.
+class TransferMeter(object):
+    def __init__(self, file, log, name, interval=5):
+        self.log = log
+        self._file = file
+        self._name = name
+        self._interval = interval
+        self._size = 0
+        self._start = self._reported = time.monotonic()
+
+    def _format(self):
+        mib = self._size / (1024 * 1024)
+        seconds = time.monotonic() - self._start
+        return '%.1f MiB in %.1f s, %.1f MiB/s' % (
+                   mib, seconds, mib / max(seconds, 0.001))
+
+    def _count(self, size):
+        self._size += size
+        now = time.monotonic()
+        if now - self._reported >= self._interval:
+            self._reported = now
+            self.log.log_progress('%s: %s...' % (self._name,
+                                                 self._format()))
+
+    def read(self, size=-1):
+        data = self._file.read(size)
+        self._count(len(data))
+        return data
+
+    def write(self, data):
+        self._file.write(data)
+        self._count(len(data))
+
+    def report(self):
+        self.log('%s: %s.' % (self._name, self._format()))
+
+
+# Connects a writer running in a separate thread to a reader in
+# the current one.
+class _Pipe(object):
+    def __init__(self, write):
+        read_fd, write_fd = os.pipe()
+        self.reader = open(read_fd, 'rb')
+        self._writer = open(write_fd, 'wb')
+        self._error = None
+        self._thread = threading.Thread(target=self._write, args=(write,))
+        self._thread.start()
+
+    def _write(self, write):
+        try:
+            write(self._writer)
+        except Exception as e:
+            self._error = e
+        finally:
+            try:
+                self._writer.close()
+            except BrokenPipeError:
+                pass
+
+    def close(self):
+        self.reader.close()
+        self._thread.join()
+        if self._error:
+            raise self._error
+
+
+# Stores file contents on the local disk addressed by their
+# SHA-256 hashes, along with manifests of snapshots referring to
+# them. Contents shared between snapshots are stored once.
+class ChunkStore(object):
+    def __init__(self, path):
+        self._path = path
+        self._chunks_path = os.path.join(path, 'chunks')
+        self._snapshots_path = os.path.join(path, 'snapshots')
+
+    def _get_chunk_path(self, hash):
+        return os.path.join(self._chunks_path, hash[:2], hash)
+
+    def has_chunk(self, hash):
+        return os.path.exists(self._get_chunk_path(hash))
+
+    # Stores contents read from the file. Returns their hash.
+    def add_chunk(self, file):
+        os.makedirs(self._chunks_path, exist_ok=True)
+        hasher = hashlib.sha256()
+        with tempfile.NamedTemporaryFile(dir=self._chunks_path,
+                                         delete=False) as f:
+            while True:
+                data = file.read(LocalShell._CHUNK_SIZE)
+                if not data:
+                    break
+                hasher.update(data)
+                f.write(data)
+
+        hash = hasher.hexdigest()
+        path = self._get_chunk_path(hash)
+        if os.path.exists(path):
+            os.remove(f.name)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.rename(f.name, path)
+        return hash
+
+    def open_chunk(self, hash):
+        return open(self._get_chunk_path(hash), 'rb')
+
+    def get_chunk_size(self, hash):
+        return os.path.getsize(self._get_chunk_path(hash))
+
+    def get_snapshot_ids(self):
+        if not os.path.exists(self._snapshots_path):
+            return []
+
+        return sorted(name[:-len('.json')]
+                      for name in os.listdir(self._snapshots_path)
+                      if name.endswith('.json'))
+
+    def load_snapshot(self, id):
+        with open(os.path.join(self._snapshots_path, id + '.json'),
+                  'rt') as f:
+            return json.load(f)
+
+    def save_snapshot(self, manifest):
+        os.makedirs(self._snapshots_path, exist_ok=True)
+        base_id = id = time.strftime('%Y%m%d-%H%M%S', time.gmtime())
+        path = os.path.join(self._snapshots_path, id + '.json')
+        n = 1
+        while os.path.exists(path):
+            id = '%s-%d' % (base_id, n)
+            path = os.path.join(self._snapshots_path, id + '.json')
+            n += 1
+        with open(path + '.tmp', 'wt') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        os.rename(path + '.tmp', path)
+        return id
+
+
+# Remembers the steps that have completed, along with the keys of
+# their inputs, so that an interrupted run can resume where it
+# stopped. The journal is saved after every step. Steps are only
+# considered done on the target they ran on, e.g., a container.
+class StepJournal(object):
+    def __init__(self, path):
+        self._path = path
+        self._target = None
+        self._keys = dict()
+        self._lock = threading.Lock()
+
+        try:
+            with open(path, 'rt') as f:
+                journal = json.load(f)
+            self._target = journal.get('target')
+            self._keys = journal.get('steps', dict())
+        except FileNotFoundError:
+            pass
+
+    # Forgets all steps if they were journaled for another target,
+    # such as a container since recreated under the same name.
+    # Returns whether they were forgotten.
+    def set_target(self, target):
+        with self._lock:
+            if self._target == target:
+                return False
+
+            forgotten = bool(self._keys)
+            self._target = target
+            self._keys = dict()
+            self._save()
+            return forgotten
+
+    def is_done(self, id, key):
+        with self._lock:
+            return self._keys.get(id) == key
+
+    def _save(self):
+        tmp_path = self._path + '.tmp'
+        with open(tmp_path, 'wt') as f:
+            json.dump({'target': self._target, 'steps': self._keys}, f,
+                      indent=1, sort_keys=True)
+            f.write('\n')
+        os.rename(tmp_path, self._path)
+
+    def record(self, id, key):
+        with self._lock:
+            self._keys[id] = key
+            self._save()
+
+    def clear(self):
+        with self._lock:
+            self._keys = dict()
+            self._save()
+
+
+# Runs named steps in the order of their dependencies. Steps that
+# do not depend on each other run concurrently, up to the given
+# number of jobs. The log output of every step is collected and
+# written out in the order the steps were added.
+#
+# Every step has a key, which is a hash of its ID, inputs and keys
+# of its dependencies. With a journal specified, steps whose keys
+# are journaled as completed are skipped, so a step only reruns
+# when it or any of the steps it depends on has changed.
+class Tasks(object):
+    def __init__(self, log, jobs=4, journal=None):
+        self.log = log
+        self._jobs = max(1, jobs)
+        self._journal = journal
+        self._tasks = dict()
+        self._keys = dict()
+
+    def __contains__(self, id):
+        return id in self._tasks
+
+    def get_ids(self):
+        return list(self._tasks)
+
+    # Returns the given steps and all steps that depend on them,
+    # directly or not, in the order of adding.
+    def get_dependents(self, ids):
+        selected = set(ids)
+        for id, (func, deps) in self._tasks.items():
+            if any(dep in selected for dep in deps):
+                selected.add(id)
+        return [id for id in self._tasks if id in selected]
+
+    # Steps can only depend on steps added before them, so the
+    # order of adding is always a valid order of execution. Steps
+    # with no function just group their dependencies. The inputs
+    # are any JSON-serializable values the step depends on.
+    def add(self, id, func, deps=(), inputs=None):
+        if id in self:
+            raise Error('Task %s already exists.' % repr(id))
+
+        for dep in deps:
+            if dep not in self:
+                raise Error('Task %s depends on unknown task %s.' % (
+                                repr(id), repr(dep)))
+
+        self._tasks[id] = func, list(deps)
+        self._keys[id] = hashlib.sha256(json.dumps(
+            [id, inputs, [self._keys[dep] for dep in deps]],
+            sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _skip_task(self, id):
+        self.log('Skip %s, done before.' % id)
+
+    def _run_task(self, id, func):
+        self.log.log_step(id)
+        if self._jobs == 1:
+            try:
+                func()
+            finally:
+                self.log.log_step_end()
+            return [], None
+
+        self.log.capture()
+        try:
+            func()
+            error = None
+        except Exception as e:
+            error = e
+        self.log.log_step_end()
+        return self.log.release(), error
+
+    # Runs the given steps or all of them. Steps not selected are
+    # considered done.
+    def run(self, ids=None):
+        pending = [id for id in self._tasks if ids is None or id in ids]
+        order = list(pending)
+        done = set(self._tasks) - set(pending)
+        outputs = dict()
+        running = dict()
+        errors = []
+
+        with concurrent.futures.ThreadPoolExecutor(self._jobs) as executor:
+            while pending or running:
+                for id in list(pending):
+                    if errors or len(running) >= self._jobs:
+                        break
+
+                    func, deps = self._tasks[id]
+                    if all(dep in done for dep in deps):
+                        pending.remove(id)
+                        if not func:
+                            func = _do_nothing
+                        elif (self._journal and
+                                self._journal.is_done(id, self._keys[id])):
+                            func = functools.partial(self._skip_task, id)
+                        running[executor.submit(self._run_task, id,
+                                                func)] = id
+
+                if not running:
+                    break
+
+                finished, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    id = running.pop(future)
+                    outputs[id], error = future.result()
+                    if error:
+                        errors.append(error)
+                        continue
+
+                    done.add(id)
+                    if (self._journal and
+                            not self._journal.is_done(id, self._keys[id])):
+                        self._journal.record(id, self._keys[id])
+
+                # Write out output of the steps that have finished
+                # and precede any unfinished ones.
+                while order and order[0] in outputs:
+                    self.log.replay(outputs.pop(order.pop(0)))
+
+        for id in order:
+            if id in outputs:
+                self.log.replay(outputs[id])
+
+        if errors:
+            raise errors[0]
+
+
+class Ubuntu(object):
+    # Records the key of the package set installed and when it was
+    # installed, so that containers created from cached images can
+    # tell whether they already have the packages.
+    _packages_marker_path = '/etc/wheelcode-packages'
+
+    def __init__(self, shell, image_cache=None):
         self.shell = shell
         self.log = shell.log
+        self._image_cache = image_cache
+
+        # Packages services and applications requested on
+        # initialization. They all are installed in a single
+        # transaction.
+        self._required_packages = []
+        self._installed_packages = set()
+
+        self._updated = False
+        self._upgraded = False
 
     def _apt_get(self, args):
         self.shell.run(['DEBIAN_FRONTEND=noninteractive', 'apt-get'] + args)
 
     def update(self):
-        # TODO: Do it once per session.
-        self._apt_get(['update'])
+        if not self._updated:
+            self._apt_get(['update'])
+            self._updated = True
 
     def upgrade(self):
-        # TODO: Do it once per session.
-        self._apt_get(['upgrade', '--yes'])
+        if not self._upgraded:
+            self._apt_get(['upgrade', '--yes'])
+            self._upgraded = True
 
     def update_upgrade(self):
         self.update()
         self.upgrade()
 
+    def require_packages(self, packages):
+        for package in packages:
+            if package not in self._required_packages:
+                self._required_packages.append(package)
+
     def install_packages(self, packages):
-        # TODO: Remember installed packages and do not try to install them
-        #       again.
-        self._apt_get(['install', '--yes'] + packages)
+        packages = [package for package in packages
+                    if package not in self._installed_packages]
+        if packages:
+            self._apt_get(['install', '--yes'] + packages)
+            self._installed_packages.update(packages)
+
+    def _has_cached_packages(self, key):
+        path = self._packages_marker_path
+        files = self.shell.read_files([path])
+        if path not in files:
+            return False
+
+        content, owner, mode = files[path]
+        fields = content.decode('ascii', errors='replace').split()
+        return (len(fields) == 2 and fields[0] == key and fields[1].isdigit()
+                and time.time() - int(fields[1]) < self._image_cache.max_age)
+
+    def install_required_packages(self):
+        self.log('Install system packages.')
+
+        key = None
+        if self._image_cache:
+            key = self._image_cache.get_key(self._required_packages)
+            if self._has_cached_packages(key):
+                self.log('System packages are installed in the cached '
+                         'image.')
+                self._updated = self._upgraded = True
+                self._installed_packages.update(self._required_packages)
+                return
+
+        self.update_upgrade()
+        self.install_packages(self._required_packages)
+
+        if key:
+            marker = '%s %d\n' % (key, int(time.time()))
+            self.shell.write_file(self._packages_marker_path,
+                                  marker.encode('ascii'))
+            self._image_cache.commit(key)
+
+    def add_install_tasks(self, tasks):
+        if 'system.packages' not in tasks:
+            tasks.add('system.packages', self.install_required_packages,
+                      inputs=self._required_packages)
 
     def manage_service(self, service, action):
         self.shell.run(['service', service, action])
@@ -215,8 +2360,90 @@ class Ubuntu(object):
         return status == 0
 
 
+# Keeps a single MySQL client connection open and sends queued
+# statements to it in batches. Every batch is followed by a query
+# printing a sentinel, and errors are attributed to statements by
+# the line numbers the client reports.
+class MySQLSession(object):
+    def __init__(self, shell, client_command):
+        self.shell = shell
+        self.log = shell.log
+        self._client_command = client_command
+        self._session = None
+        self._statements = []
+        self._error_pattern = re.compile(
+            r'^ERROR (\d+) \(\w+\)(?: at line (\d+))?: (.*)$')
+
+    def execute(self, statement):
+        statement = statement.strip().replace('\n', ' ')
+        if not statement.endswith(';'):
+            statement += ';'
+        self._statements.append(statement)
+
+    def drop_user_if_exists(self, user, host='localhost'):
+        self.execute("DROP USER IF EXISTS '%s'@'%s'" % (user, host))
+
+    def create_user(self, user, password, host='localhost'):
+        self.execute("CREATE USER '%s'@'%s' IDENTIFIED BY '%s'" % (
+                         user, host, password))
+
+    def grant(self, privileges, objects, user, host='localhost'):
+        self.execute("GRANT %s ON %s TO '%s'@'%s'" % (
+                         privileges, objects, user, host))
+
+    # Sends the queued statements. Returns the output of the client
+    # and raises an error listing every failed statement, unless
+    # failures are allowed.
+    def flush(self, may_fail=False):
+        statements, self._statements = self._statements, []
+        if not statements:
+            return ''
+
+        if self._session is None:
+            self._session = self.shell.open_session(
+                '%s --batch --skip-column-names --force --unbuffered 2>&1' % (
+                    self._client_command))
+            self._line = 0
+
+        for statement in statements:
+            self.log.log_shell_command(['mysql>', statement])
+
+        sentinel = self._session.new_sentinel()
+        request = '\n'.join(statements + ["SELECT '%s';" % sentinel, ''])
+        output, _, _ = self._session.exchange(request, sentinel,
+                                              stderr_sentinel=False)
+        first_line = self._line + 1
+        self._line += len(statements) + 1
+
+        lines = []
+        failures = []
+        for line in output.decode('utf-8', errors='replace').splitlines():
+            match = self._error_pattern.match(line)
+            if not match:
+                lines.append(line)
+                continue
+
+            index = int(match.group(2) or first_line) - first_line
+            failures.append('ERROR %s: %s\n    %s' % (
+                match.group(1), match.group(3),
+                statements[index] if 0 <= index < len(statements) else '?'))
+
+        if failures and not may_fail:
+            raise Error('MySQL statements failed:\n%s' % '\n'.join(failures))
+
+        return '\n'.join(lines)
+
+    def close(self):
+        self._statements = []
+        if self._session:
+            self._session.close()
+            self._session = None
+
+
 class MariaDB(object):
-    def __init__(self, system, config=Config()):
+    # A session object implementing the MySQLSession interface can
+    # be passed to run statements against a stand-in.
+    def __init__(self, system, config=Config(), session=None):
         self.system = system
         self.shell = system.shell
         self.log = system.log
@@ -225,7 +2452,19 @@ class MariaDB(object):
 
         self._config.set_default('root.password', generate_password())
 
+        self.system.require_packages(['mariadb-server'])
+
         self._daemon_option_prefix = 'daemon.'
+        self._pid_path = '/run/mysqld/mysqld.pid'
+
+        # Lets clients in the container log in as root without
+        # passing the password on the command line.
+        self._client_config_path = '/root/.wheelcode-mysql.cnf'
+        self._client_config_installed = False
+        self._client_command = 'mysql --defaults-extra-file=%s' % (
+                                   self._client_config_path)
+        self._session = session or MySQLSession(self.shell,
+                                                self._client_command)
 
         self._installed = False
         self._started = False
@@ -241,57 +2480,126 @@ class MariaDB(object):
             id = self._daemon_option_prefix + id
             self._config[id] = value
 
-    def _install_config_file(self):
+    def _generate_config_file(self):
         lines = ['', '[mysqld]']
         for id, value in self._config:
             if id.startswith(self._daemon_option_prefix):
                 id = id[len(self._daemon_option_prefix):]
                 lines.append('%s = %s' % (id, value))
         lines.append('')
+        return '\n'.join(lines)
 
-        self.shell.write_file('/etc/mysql/mariadb.conf.d/99-custom_config.cnf',
-                              '\n'.join(lines).encode('utf-8'))
+    # Restarts the daemon if it might be running with an older
+    # configuration. A file that is already up to date, but that
+    # the shell has not seen before, might have been written by an
+    # interrupted run, so then the daemon is restarted if it was
+    # started before the file was written.
+    def _install_config_file(self):
+        path = '/etc/mysql/mariadb.conf.d/99-custom_config.cnf'
+        known = path in self.shell.get_manifest()
+        if self.shell.write_file(
+                path, self._generate_config_file().encode('utf-8')):
+            self.restart()
+        elif not known:
+            status, stdout = self.shell.run(['test', path, '-nt',
+                                             self._pid_path], may_fail=True)
+            if status == 0:
+                self.restart()
+
+    def _install_client_config(self, password):
+        text = '[client]\nuser = root\npassword = %s\n' % password
+        self.shell.write_file(self._client_config_path,
+                              text.encode('utf-8'),
+                              owner='root:root', mode=0o600)
+        self._client_config_installed = True
+
+    # Makes sure clients can connect to the daemon. Until a new root
+    # password is set, clients log in with the one last applied.
+    def _prepare_client(self):
+        self.start()
 
-    def install(self):
-        self.system.update_upgrade()
-        self.system.install_packages(['mariadb-server'])
+        if not self._client_config_installed:
+            self._install_client_config(
+                self._config.get_applied('root.password') or
+                self._config['root.password'])
 
-        self._install_config_file()
+    def get_client_command(self):
+        self._prepare_client()
+        return self._client_command
 
-        self.log('Set root password and disable plugin login.')
-        self._execute("use mysql; "
-                      "update user set plugin='' where User='root'; "
-                      "set password = password('%s');"
-                      "flush privileges;" % self._config['root.password'])
+    def get_dump_command(self):
+        self._prepare_client()
+        return 'mysqldump --defaults-extra-file=%s' % self._client_config_path
 
-        self._installed = True
+    def get_databases(self, pattern):
+        session = self.get_session()
+        session.execute("SHOW DATABASES LIKE '%s'" % pattern)
+        return session.flush().split()
 
-    def _execute(self, commands, may_fail=False):
-        # We need the daemon to be started.
-        self.start()
+    def get_global_variable(self, id):
+        session = self.get_session()
+        session.execute('SELECT @@GLOBAL.%s' % id)
+        return session.flush().strip()
 
-        self.shell.run(
-            command='mysql --user=root --password=%s '
-                    '--execute "%s"' % (
-                        self._config['root.password'], commands),
-            may_fail=may_fail)
+    def set_global_variable(self, id, value):
+        self._execute(['SET GLOBAL %s = %s' % (id, value)])
+
+    def _set_root_password(self):
+        self.log('Set root password and disable plugin login.')
+        self._execute(["use mysql",
+                       "update user set plugin='' where User='root'",
+                       "set password = password('%s')" % (
+                           self._config['root.password']),
+                       "flush privileges"])
+        self._install_client_config(self._config['root.password'])
+
+    # Returns IDs of install steps affected by changes in the
+    # given options.
+    def get_affected_steps(self, ids):
+        steps = set()
+        for id in ids:
+            if id.startswith(self._daemon_option_prefix):
+                steps.add('mysql.config')
+            elif id == 'root.password':
+                steps.add('mysql.root-password')
+            else:
+                steps.update(['mysql.config', 'mysql.root-password'])
+        return steps
+
+    def add_install_tasks(self, tasks):
+        self._installed = True
+
+        self.system.add_install_tasks(tasks)
+        tasks.add('mysql.config', self._install_config_file,
+                  deps=['system.packages'],
+                  inputs=self._generate_config_file())
+        tasks.add('mysql.root-password', self._set_root_password,
+                  deps=['mysql.config'],
+                  inputs=self._config['root.password'])
+        tasks.add('mysql', None, deps=['mysql.root-password'])
+
+    def install(self, jobs=4):
+        tasks = Tasks(self.log, jobs)
+        self.add_install_tasks(tasks)
+        tasks.run()
+
+    def get_session(self):
+        self._prepare_client()
+        return self._session
+
+    def _execute(self, statements, may_fail=False):
+        session = self.get_session()
+        for statement in statements:
+            session.execute(statement)
+        return session.flush(may_fail)
 
     def add_user(self, user, password, privileges, objects):
-        # Drop existing user with the same name, if any.
-        # TODO: How can we make sure the failure (if any) is due
-        # to non-existing user?
-        self._execute("DROP USER '{user}'@'localhost'; ".format(
-                          user=user),
-                      may_fail=True)
-
-        # Create new user and grant specified privileges.
-        self._execute(
-            "CREATE USER '{user}'@'localhost' IDENTIFIED BY '{password}'; "
-            "GRANT {privileges} ON {objects} TO '{user}'@'localhost';".format(
-                user=user,
-                password=password,
-                privileges=privileges,
-                objects=objects))
+        # Replace existing user with the same name, if any.
+        session = self.get_session()
+        session.drop_user_if_exists(user)
+        session.create_user(user, password)
+        session.grant(privileges, objects, user)
+        session.flush()
 
     def _manage(self, action):
         self.system.manage_service('mysql', action)
@@ -302,11 +2610,13 @@ class MariaDB(object):
             self._started = True
 
     def restart(self):
+        self._session.close()
         self._manage('restart')
         self._started = True
 
     def stop(self):
         if self._started:
+            self._session.close()
             self._manage('stop')
             self._started = False
 
@@ -320,9 +2630,16 @@ class Apache2(object):
         self._config_dir = posixpath.join('/etc', 'apache2')
         self._sites_available_dir = posixpath.join(self._config_dir,
                                                    'sites-available')
+        self._sites_enabled_dir = posixpath.join(self._config_dir,
+                                                 'sites-enabled')
 
         self._sites = dict()
 
+        self.system.require_packages(
+            ['apache2',
+             'libapache2-mod-php',  # TODO: Not all setups need this.
+             ])
+
         self._installed = False
         self._started = False
 
@@ -355,9 +2672,25 @@ class Apache2(object):
 
         return '\n'.join(lines).encode('utf-8')
 
-    def _install_site_config_file(self, id, config):
-        path = posixpath.join(self._sites_available_dir, '%s.conf' % id)
-        self.shell.write_file(path, self._generate_site_config_file(config))
+    def _get_site_config_path(self, id):
+        return posixpath.join(self._sites_available_dir, '%s.conf' % id)
+
+    # Returns IDs of sites whose configuration files have changed
+    # and IDs of sites whose files the shell has not seen before.
+    def _install_site_config_files(self):
+        paths = {self._get_site_config_path(id): id for id in self._sites}
+        manifest = self.shell.get_manifest()
+        unknown = [id for path, id in paths.items() if path not in manifest]
+        written = self.shell.write_files(
+            [(path, self._generate_site_config_file(self._sites[id]),
+              'root:root', 0o644) for path, id in paths.items()])
+        return [paths[path] for path in written], unknown
+
+    def _get_enabled_sites(self):
+        status, stdout = self.shell.run(['ls', self._sites_enabled_dir],
+                                        may_fail=True)
+        return {name[:-len('.conf')] for name in stdout.split()
+                if name.endswith('.conf')}
 
     def _enable_site(self, id):
         self.shell.run(['a2ensite', id])
@@ -368,27 +2701,46 @@ class Apache2(object):
     def _disable_default_site(self):
         self._disable_site('000-default')
 
-    def install(self):
-        self.log('Install Apache2.')
-        self.system.update_upgrade()
-        self.system.install_packages(
-            ['apache2',
-             'libapache2-mod-php',  # TODO: Not all setups need this.
-             ])
-
+    def _enable_modules(self):
+        self.log('Enable Apache2 modules.')
         self.shell.run('a2enmod rewrite')  # TODO: Not all setups need this.
         self.shell.run('a2enmod ssl')      # TODO: Not all setups need this.
 
-        for id, config in self._sites.items():
-            self._install_site_config_file(id, config)
-
-        self._disable_default_site()
-
-        for id in self._sites:
+    # Sites whose files have changed are enabled. Up-to-date files
+    # the shell has not seen before might have been written by an
+    # interrupted run, so then the sites are enabled and disabled
+    # as their actual state requires.
+    def _install_sites(self):
+        self.log('Install Apache2 sites.')
+        changed, unknown = self._install_site_config_files()
+
+        if any(id not in changed for id in unknown):
+            enabled = self._get_enabled_sites()
+            if '000-default' in enabled:
+                self._disable_default_site()
+            changed = [id for id in self._sites if id not in enabled]
+        elif changed:
+            self._disable_default_site()
+
+        for id in changed:
             self._enable_site(id)
 
+    def add_install_tasks(self, tasks):
         self._installed = True
 
+        self.system.add_install_tasks(tasks)
+        tasks.add('apache2.modules', self._enable_modules,
+                  deps=['system.packages'])
+        tasks.add('apache2.sites', self._install_sites,
+                  deps=['system.packages'],
+                  inputs=self._sites)
+        tasks.add('apache2', None, deps=['apache2.modules', 'apache2.sites'])
+
+    def install(self, jobs=4):
+        tasks = Tasks(self.log, jobs)
+        self.add_install_tasks(tasks)
+        tasks.run()
+
     def _manage(self, action):
         self.system.manage_service('apache2', action)
 
@@ -415,6 +2767,21 @@ class PHP(object):
 
         self._config = dict()
 
+        self._sapis = ['apache2', 'cli', 'fpm']
+        self._option_pattern = re.compile(r'^\s*;?\s*([\w.]+)\s*=')
+
+        self.system.require_packages(
+            ['php',
+             'php-mysql',  # Not all setups need these packages.
+             'php-gd',
+             'php-curl',
+             'php-apcu',
+             'php-cli',
+             'php-json',
+             'php-mbstring',
+             'php-zip',
+            ])
+
         self._installed = False
 
     def configure(self, config):
@@ -431,37 +2798,235 @@ class PHP(object):
                             'option %s: %s and %s' % (
                                 option, self._config[option], value))
 
+    # Returns paths to php.ini files of all installed PHP versions
+    # and supported SAPIs.
+    def _find_config_files(self):
+        status, stdout = self.shell.run('ls /etc/php/*/*/php.ini',
+                                        may_fail=True)
+        paths = [path for path in stdout.split()
+                 if posixpath.basename(posixpath.dirname(path)) in self._sapis]
+        if not paths:
+            raise Error('Cannot find PHP configuration files.')
+
+        return paths
+
+    # Sets the options, both active and commented out, in a single
+    # pass. Options not mentioned in the file are appended to it.
+    def _update_config_text(self, text):
+        lines = text.split('\n')
+        missing = dict(self._config)
+        for i, line in enumerate(lines):
+            match = self._option_pattern.match(line)
+            if match and match.group(1) in self._config:
+                option = match.group(1)
+                lines[i] = '%s = %s' % (option, self._config[option])
+                missing.pop(option, None)
+
+        if missing and lines[-1] == '':
+            lines.pop()
+        for option, value in missing.items():
+            lines.append('%s = %s' % (option, value))
+        if missing:
+            lines.append('')
+
+        return '\n'.join(lines)
+
     def _update_config_file(self):
-        config_file_path = '/etc/php/7.2/apache2/php.ini'
-        for option, value in self._config.items():
-            self.shell.run(
-                'sed -i -r "/%s ?=/{ s#.*#%s = %s# }" %s' % (
-                    option.replace('.', r'\.'), option, value,
-                    config_file_path))
-
-    def install(self):
-        self.log('Install PHP.')
-        self.system.update_upgrade()
-
-        self.system.install_packages(
-            ['php',
-             'php-mysql',  # Not all setups need these packages.
-             'php-gd',
-             'php-curl',
-             'php-apcu',
-             'php-cli',
-             'php-json',
-             'php-mbstring',
-             'php-zip',
-            ])
+        files = self.shell.read_files(self._find_config_files())
 
+        updates = []
+        for path, (content, owner, mode) in files.items():
+            text = content.decode('utf-8')
+            new_text = self._update_config_text(text)
+            if new_text != text:
+                updates.append((path, new_text.encode('utf-8'), owner, mode))
+
+        if updates:
+            self.shell.write_files(updates)
+
+    def _configure(self):
+        self.log('Configure PHP.')
         self._update_config_file()
 
+    def add_install_tasks(self, tasks):
         self._installed = True
 
+        self.system.add_install_tasks(tasks)
+        tasks.add('php.config', self._configure, deps=['system.packages'],
+                  inputs=[self._sapis, self._config])
+        tasks.add('php', None, deps=['php.config'])
+
+    def install(self, jobs=4):
+        tasks = Tasks(self.log, jobs)
+        self.add_install_tasks(tasks)
+        tasks.run()
+
+
+# Maintains bare mirrors of git repositories in a local directory.
+# Every mirror is updated at most once per session. Caches on the
+# same directory, e.g., of instances deployed at once, share their
+# mirrors, so every mirror is updated under a lock of its own.
+class GitMirrorCache(object):
+    _updated = set()
+    _mirror_locks = dict()
+    _lock = threading.Lock()
+
+    def __init__(self, shell, path):
+        self.shell = shell
+        self.log = shell.log
+        self._path = path
+
+    def get_mirror(self, name, url):
+        path = os.path.abspath(os.path.join(self._path, '%s.git' % name))
+        with self._lock:
+            lock = self._mirror_locks.setdefault(path, threading.Lock())
+
+        with lock:
+            if path in self._updated:
+                return path
+
+            if os.path.exists(path):
+                self.shell.run(['git', '--git-dir', path,
+                                'remote', 'update', '--prune'])
+            else:
+                os.makedirs(self._path, exist_ok=True)
+                self.shell.run(['git', 'clone', '--mirror', url, path])
+
+            self._updated.add(path)
+
+        return path
+
+
+# Keeps images of containers committed as soon as system packages
+# are installed in them, so that new containers can be created from
+# these images and skip installing the packages. Images are tagged
+# with a key of the package set and the image the container was
+# originally created from, which is also recorded in a label that
+# containers inherit. Packages installed longer than the maximum
+# age ago are installed again, which commits a fresh image. Steps
+# running alongside the installation of packages may leave their
+# files in the images, too. Only a few most recent images are kept.
+class BaseImageCache(object):
+    repository = 'wheelcode-base'
+    _label = 'wheelcode.base-image'
+
+    def __init__(self, shell, container_name, keep=3,
+                 max_age=30 * 24 * 60 * 60):
+        self.shell = shell
+        self.log = shell.log
+        self.container_name = container_name
+        self.keep = keep
+        self.max_age = max_age
+        self._base_image = None
+
+    def _get_base_image(self):
+        if self._base_image is None:
+            status, stdout = self.shell.run(
+                ['docker', 'container', 'inspect', '--format',
+                 '{{json .Config}}', self.container_name])
+            config = json.loads(stdout)
+            labels = config.get('Labels') or dict()
+            self._base_image = labels.get(self._label, config['Image'])
+        return self._base_image
+
+    def get_key(self, packages):
+        content = json.dumps([self._get_base_image(), sorted(packages)])
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+    def commit(self, key):
+        image = '%s:%s' % (self.repository, key)
+        self.log('Cache the base image as %s.' % image)
+        self.shell.run(['docker', 'container', 'commit', '--change',
+                        'LABEL %s=%s' % (self._label, self._get_base_image()),
+                        self.container_name, image])
+        self.prune()
+
+    # Removes all but the most recent images. Images still used by
+    # containers remain. Images committed again under the same tag
+    # are removed, too.
+    def prune(self):
+        status, stdout = self.shell.run(
+            ['docker', 'image', 'ls', '--format', '{{.Repository}}:{{.Tag}}',
+             self.repository])
+        images = stdout.split()[self.keep:]
+        if images:
+            self.shell.run(['docker', 'image', 'rm'] + images, may_fail=True)
+
+        self.shell.run(['docker', 'image', 'prune', '--force',
+                        '--filter', 'label=%s' % self._label])
+
+
+# Retrieves git repositories into a shell. Clones can be shallow
+# or single-branch, and, given a mirror cache, are seeded from the
+# local mirrors instead of being downloaded from upstream. A URL
+# base that is a local directory is only accessible here, so then
+# clones are seeded from the local repositories themselves.
+class GitFetcher(object):
+    def __init__(self, shell, url_base, depth=None, single_branch=False,
+                 branch=None, mirror_cache=None):
+        self.shell = shell
+        self.log = shell.log
+        self._url_base = url_base
+        self._depth = depth
+        self._single_branch = single_branch
+        self._branch = branch
+        self._mirror_cache = mirror_cache
+
+    def get_url(self, name):
+        return '%s/%s.git' % (self._url_base.rstrip('/'), name)
+
+    def _get_clone_options(self):
+        options = []
+        if self._depth:
+            options.extend(['--depth', str(self._depth)])
+        if self._single_branch:
+            options.append('--single-branch')
+        if self._branch:
+            options.extend(['--branch', self._branch])
+        return options
+
+    # Returns the local repository to seed the clone from, if any.
+    def _get_local_repository(self, name, url):
+        if self._mirror_cache:
+            return self._mirror_cache.get_mirror(name, url)
+        if '://' not in url and os.path.isdir(url):
+            return url
+        return None
+
+    def fetch(self, name, path, user=None):
+        url = self.get_url(name)
+        self.shell.run(['mkdir', '-p', posixpath.dirname(path)], user=user)
+
+        local = self._get_local_repository(name, url)
+        if not local:
+            self.shell.run(['git', 'clone'] + self._get_clone_options() +
+                           [url, path], user=user)
+            return
+
+        seed = '/tmp/wheelcode-seed-%s-%s.git' % (name, secrets.token_hex(4))
+        self.shell.copy_dir(local, seed)
+        self.shell.run(['chmod', '-R', 'a+rX', seed])
+        try:
+            self.shell.run(['git', 'clone'] + self._get_clone_options() +
+                           ['file://%s' % seed, path], user=user)
+        finally:
+            self.shell.run(['rm', '-rf', seed])
+        self.shell.run(['git', '-C', path, 'remote', 'set-url', 'origin', url],
+                       user=user)
+
+    def update(self, name, path, user=None):
+        options = []
+        if self._depth:
+            options.extend(['--depth', str(self._depth)])
+        self.shell.run(['git', '-C', path, 'pull'] + options, user=user)
+
 
 class Phabricator(object):
-    def __init__(self, mysql, webserver, php, config=Config()):
+    # With a step journal specified, installing resumes from the
+    # first step that has not completed or whose inputs have
+    # changed.
+    def __init__(self, mysql, webserver, php, config=Config(),
+                 mirror_cache=None, journal=None):
         self.mysql = mysql
         self.webserver = webserver
         self.php = php
@@ -471,6 +3036,7 @@ class Phabricator(object):
         self.log = self.mysql.log
 
         self._config = config
+        self._journal = journal
 
         # Shall be unique among all applications we support.
         self._config.set_default('app.id', 'phabricator')
@@ -491,6 +3057,21 @@ class Phabricator(object):
 
         self._config.set_default('app.git.user.name', 'git')
 
+        # Set the URL base to a local directory to retrieve the
+        # components from local repositories. The depth of None
+        # means full clones.
+        self._config.set_default('app.components.url-base',
+                                 'https://github.com/phacility')
+        self._config.set_default('app.components.depth', None)
+        self._config.set_default('app.components.single-branch', False)
+
+        self._fetcher = GitFetcher(
+            self.shell,
+            url_base=self._config['app.components.url-base'],
+            depth=self._config['app.components.depth'],
+            single_branch=self._config['app.components.single-branch'],
+            mirror_cache=mirror_cache)
+
         self._app_path = posixpath.join('/opt', self._config['app.id'])
         self._phabricator_path = posixpath.join(self._app_path, 'phabricator')
         self._webroot_path = posixpath.join(self._phabricator_path, 'webroot')
@@ -549,20 +3130,82 @@ class Phabricator(object):
             'opcache.validate_timestamps': '0',
         })
 
+        # https://secure.phabricator.com/source/phabricator/browse/master/scripts/install/install_ubuntu.sh
+        # https://gist.github.com/sparrc/b4eff48a3e7af8411fc1
+        self.system.require_packages(
+            ['sudo',
+             'openssh-server',
+             'git',
+             'mercurial',
+             'subversion',
+             'python-pygments',
+             # 'sendmail',  # TODO: Do we need it?
+             'imagemagick',
+             'zstd',  # For streaming backups.
+             ])
+
+        self._settings = dict()
+        self.configure({
+            'mysql.user': self._config['mysql.user.name'],
+            'mysql.pass': self._config['mysql.user.password'],
+            'phd.user': self._config['app.daemon.user.name'],
+
+            'phabricator.base-uri':
+                'http://%s/' % self._config['app.domain-base'],
+            'security.alternate-file-domain':
+                'http://%s/' % self._config['app.domain-files'],
+
+            'pygments.enabled': True,
+
+            # TODO: It seems we now should configure 'cluster.mailers'
+            # instead.
+            # 'metamta.mail-adapter':
+            #     'PhabricatorMailImplementationPHPMailerAdapter',
+
+            'repository.default-local-path': self._repos_path,
+            'storage.local-disk.path': self._files_path,
+
+            # By default, Phabricator saves 1MiB files in the
+            # database. Disabling this to make the database (and
+            # especially dumps) faster.
+            'storage.mysql-engine.max-size': 0,
+
+            'diffusion.ssh-user': self._config['app.git.user.name'],
+            'diffusion.ssh-port': 2222,
+        })
+
         self._daemon_started = False
 
     def get_config(self):
         return self._config
 
-    def _run_config_set(self, id, value):
-        config_path = posixpath.join(self._phabricator_path, 'bin', 'config')
-        self.shell.run([config_path, 'set', id, value],
-                       user=self._config['app.daemon.user.name'])
+    # Sets Phabricator options. They all are applied at once
+    # on installation.
+    def configure(self, settings):
+        for id, value in settings.items():
+            if id in self._settings and self._settings[id] != value:
+                raise Error('Conflicting values for Phabricator '
+                            'option %s: %s and %s' % (
+                                id, self._settings[id], value))
+
+            self._settings[id] = value
 
-    def _run_storage(self, args):
+    def _get_storage_command(self, args):
         storage_path = posixpath.join(self._phabricator_path, 'bin', 'storage')
-        self.shell.run([storage_path] + args,
-                       user=self._config['app.daemon.user.name'])
+        return [storage_path] + args
+
+    def _run_storage(self, args, output=None):
+        self.shell.run(self._get_storage_command(args),
+                       user=self._config['app.daemon.user.name'],
+                       output=output)
+
+    # Runs the storage command as the daemon user at the head of a
+    # pipeline of the given commands.
+    def _run_storage_pipeline(self, args, commands, output=None):
+        command = _get_user_command(self._get_storage_command(args),
+                                    self._config['app.daemon.user.name'])
+        self.shell.run(_get_pipeline_command(command, *commands),
+                       output=output)
 
     def _run_storage_as_root(self, args):
         # TODO: Have a password for the root MySQL user.
@@ -573,37 +3216,58 @@ class Phabricator(object):
     def _upgrade_storage(self):
         self._run_storage_as_root(['upgrade'])
 
+    # Makes directories and files under the path have the given
+    # owner and modes. The tree is walked once and only entries
+    # that differ are changed, in batches.
+    def _reconcile_permissions(self, path, owner, dir_mode, file_mode):
+        user, group = owner.split(':')
+        script = (
+            'd=$(mktemp -d) && trap \'rm -rf "$d"\' EXIT && '
+            'find {path} '
+            '\\( ! -user {user} -o ! -group {group} \\) '
+            '-fprint0 "$d/owners" , '
+            '-type d ! -perm {dir_mode} -fprint0 "$d/dirs" , '
+            '-type f ! -perm {file_mode} -fprint0 "$d/files" , '
+            '-fprintf "$d/all" "\\0" && '
+            'xargs -0 -r chown -h {owner} <"$d/owners" && '
+            'xargs -0 -r chmod {dir_mode} <"$d/dirs" && '
+            'xargs -0 -r chmod {file_mode} <"$d/files" && '
+            'for f in all owners dirs files; do '
+            'tr -cd "\\000" <"$d/$f" | wc -c; '
+            'done').format(path=path, user=user, group=group, owner=owner,
+                           dir_mode=dir_mode, file_mode=file_mode)
+        status, stdout = self.shell.run([script])
+
+        counts = [int(n) for n in stdout.split()]
+        if len(counts) != 4:
+            raise Error('Unexpected output of reconciling permissions '
+                        'in %s: %s' % (path, repr(stdout)))
+
+        checked, owners, dirs, files = counts
+        self.log('Checked %d entries in %s; changed owner of %d and '
+                 'mode of %d.' % (checked, path, owners, dirs + files))
+
     def _set_up_repos_dir(self):
         self.log('Set up Phabricator repositories directory.')
         self.shell.run(['mkdir', '-p', self._repos_path])
-        self.shell.run(['chown', '-R',
-                        '%s:%s' % (self._config['app.daemon.user.name'],
-                                   'www-data'),
-                        self._repos_path])
         # TODO: For some reason Phabricator changes the mode of ./config,
         #       so for now we give access to 'other' users here. Needs a
         #       proper fix.
-        self.shell.run(['find', self._repos_path, '-type', 'd',
-                        '-exec', 'chmod', '777', '{}', r'\;'])
-        self.shell.run(['find', self._repos_path, '-type', 'f',
-                        '-exec', 'chmod', '666', '{}', r'\;'])
+        self._reconcile_permissions(
+            self._repos_path,
+            '%s:%s' % (self._config['app.daemon.user.name'], 'www-data'),
+            '777', '666')
 
     def _set_up_files_dir(self):
         self.log('Set up Phabricator files directory.')
         self.shell.run(['mkdir', '-p', self._files_path])
-        self.shell.run(['chown', '-R',
-                        '%s:%s' % (self._config['app.daemon.user.name'],
-                                   'www-data'),
-                        self._files_path])
-        self.shell.run(['find', self._files_path, '-type', 'd',
-                        '-exec', 'chmod', '770', '{}', r'\;'])
-        self.shell.run(['find', self._files_path, '-type', 'f',
-                        '-exec', 'chmod', '660', '{}', r'\;'])
+        self._reconcile_permissions(
+            self._files_path,
+            '%s:%s' % (self._config['app.daemon.user.name'], 'www-data'),
+            '770', '660')
 
-    def install(self):
-        self.system.update_upgrade()
-
-        # Set up supervisor.
+    def _install_supervisor_config(self):
+        self.log('Set up supervisor.')
         # TODO: Make it to be a separate object.
         path = '/etc/supervisor/conf.d/phabricator.conf'
         text = """
@@ -643,41 +3307,19 @@ stdout_logfile=syslog
 stderr_logfile=syslog
 autorestart=true
 """
-        self.shell.write_file(path, text.encode('utf-8'))
-        self.shell.run(['chown', 'root:root', path])
-        self.shell.run(['chmod', '644', path])
-
-        # Set up MySQL.
-        self.mysql.install()
+        self.shell.write_file(path, text.encode('utf-8'),
+                              owner='root:root', mode=0o644)
 
+    def _create_mysql_user(self):
         self.log('Create the Phabricator MySQL user.')
         # https://coderwall.com/p/ne1thg/phabricator-mysql-permissions
         self.mysql.add_user(
             user=self._config['mysql.user.name'],
             password=self._config['mysql.user.password'],
             privileges='SELECT, INSERT, UPDATE, DELETE, EXECUTE, SHOW VIEW',
-            objects='\`phabricator\_%\`.*')
-
-        # Set up webserver.
-        self.webserver.install()
-
-        # Set up PHP.
-        self.php.install()
-
-        # Set up Phabricator.
-        self.log('Install packages Phabricator relies on.')
-        # https://secure.phabricator.com/source/phabricator/browse/master/scripts/install/install_ubuntu.sh
-        # https://gist.github.com/sparrc/b4eff48a3e7af8411fc1
-        self.system.install_packages(
-            ['sudo',
-             'openssh-server',
-             'git',
-             'mercurial',
-             'subversion',
-             'python-pygments',
-             # 'sendmail',  # TODO: Do we need it?
-             'imagemagick'])
+            objects=r'`phabricator\_%`.*')
 
+    def _create_daemon_user(self):
         self.log('Create Phabricator daemon user.')
         daemon_user = self._config['app.daemon.user.name']
         if not self.system.does_user_exist(daemon_user):
@@ -685,60 +3327,49 @@ autorestart=true
                             '--shell', '/bin/bash',
                             daemon_user])
 
+    def _create_app_dir(self):
         self.log("Create Phabricator application directory.")
+        daemon_user = self._config['app.daemon.user.name']
         self.shell.run(['mkdir', '-p', self._app_path])
         self.shell.run(['chown', '%s:%s' % (daemon_user, daemon_user),
                         self._app_path])
 
-        self._app_path = posixpath.join('/opt', self._config['app.id'])
-
-        self.log("Retrieve phabricator components.")
-        for component_name, path in self._components:
-            if not self.shell.does_file_exist(path):
-                self.shell.run('mkdir -p %s' % posixpath.dirname(path),
-                               user=daemon_user)
-                self.shell.run(
-                    'git clone https://github.com/phacility/%s.git %s' % (
-                        component_name, path),
-                    user=daemon_user)
-
-        self.log('Set up Phabricator MySQL user credentials.')
-        self._run_config_set('mysql.user', self._config['mysql.user.name'])
-        self._run_config_set('mysql.pass', self._config['mysql.user.password'])
-
-        self.log('Set up Phanricator daemon user.')
-        self._run_config_set('phd.user', daemon_user)
-
-        self.log('Configure Phabricator base and file URIs.')
-        self._run_config_set('phabricator.base-uri',
-                             "'http://%s/'" % self._config['app.domain-base'])
-        self._run_config_set('security.alternate-file-domain',
-                             "'http://%s/'" % self._config['app.domain-files'])
-
-        self.log('Enable Pygments.')
-        self._run_config_set('pygments.enabled', 'true')
-
-        # TODO: It seems we now should configure 'cluster.mailers' instead.
-        # self.log('Configure Phabricator outbound mail.')
-        # self._run_config_set('metamta.mail-adapter',
-        #                      'PhabricatorMailImplementationPHPMailerAdapter')
-
-        self._set_up_repos_dir()
-        self._run_config_set('repository.default-local-path', self._repos_path)
-
-        self._set_up_files_dir()
-        self._run_config_set('storage.local-disk.path', self._files_path)
-
-        self.log('Disable storing large files in MySQL.')
-        # By default, Phabricator saves 1MiB files in the
-        # database. Disabling this to make the database (and
-        # especially dumps) faster.
-        self._run_config_set('storage.mysql-engine.max-size', '0')
+    def _retrieve_component(self, component_name, path):
+        self.log("Retrieve phabricator component %s." % component_name)
+        daemon_user = self._config['app.daemon.user.name']
+        if not self.shell.does_file_exist(path):
+            self._fetcher.fetch(component_name, path, user=daemon_user)
 
+    def _configure(self):
+        self.log('Configure Phabricator.')
+        daemon_user = self._config['app.daemon.user.name']
+        path = posixpath.join(self._phabricator_path,
+                              'conf', 'local', 'local.json')
+
+        settings = dict()
+        owner, mode = '%s:%s' % (daemon_user, daemon_user), 0o644
+        files = self.shell.read_files([path])
+        if path in files:
+            content, owner, mode = files[path]
+            settings = json.loads(content.decode('utf-8'))
+
+        changed = sorted(id for id, value in self._settings.items()
+                         if id not in settings or settings[id] != value)
+        if not changed:
+            return
+
+        self.log('Set Phabricator options: %s.' % ', '.join(changed))
+        settings.update(self._settings)
+        self.shell.write_file(
+            path, (json.dumps(settings, indent=2, sort_keys=True) +
+                   '\n').encode('utf-8'),
+            owner=owner, mode=mode)
+
+    def _set_up_storage(self):
         self.log('Set up MySQL Schema.')
         self._upgrade_storage()
 
-        # Set up git access.
+    def _create_git_user(self):
         self.log('Create git user.')
         git_user = self._config['app.git.user.name']
         if not self.system.does_user_exist(git_user):
@@ -746,7 +3377,9 @@ autorestart=true
                             '--password', 'NP',
                             git_user])
 
+    def _install_sudoers_file(self):
         self.log('Allow the git user to sudo as the daemon user.')
+        git_user = self._config['app.git.user.name']
         path = '/etc/sudoers.d/%s' % self._config['app.id']
         # TODO: Do we really need the line for 'www-data'?
         text = """\
@@ -760,13 +3393,10 @@ www-data ALL=({daemon_user}) SETENV: NOPASSWD: \
 """
         text = text.format(git_user=git_user,
                            daemon_user=self._config['app.daemon.user.name'])
-        self.shell.write_file(path, text.encode('utf-8'))
-        self.shell.run(['chown', 'root:root', path])
-        self.shell.run(['chmod', '440', path])
-
-        self._run_config_set('diffusion.ssh-user', git_user)
-        self._run_config_set('diffusion.ssh-port', '2222')
+        self.shell.write_file(path, text.encode('utf-8'),
+                              owner='root:root', mode=0o440)
 
+    def _install_ssh_hook(self):
         self.log('Copy Phabricator SSH hook.')
         # TODO: Load the template, substitute values, and write back.
         path = '/usr/local/lib/phabricator-ssh-hook.sh'
@@ -789,10 +3419,10 @@ exec "$ROOT/bin/ssh-auth" $@
                             self._config['app.git.user.name'])
         text = text.replace('/path/to/phabricator',
                             self._phabricator_path)
-        self.shell.write_file(path, text.encode('utf-8'))
-        self.shell.run(['chown', 'root:root', path])
-        self.shell.run(['chmod', '755', path])
+        self.shell.write_file(path, text.encode('utf-8'),
+                              owner='root:root', mode=0o755)
 
+    def _set_up_sshd(self):
         self.log('Configure SSH for Git access.')
         path = '/etc/ssh/sshd_config.phabricator'
         text = r"""
@@ -826,8 +3456,8 @@ PidFile /var/run/sshd-phabricator.pid
         text = text.replace('vcs-user',
                             self._config['app.git.user.name'])
         # text = text.replace('Port 2222', 'Port 22')
-        self.shell.write_file(path, text.encode('utf-8'))
-        self.shell.run(['chown', 'root:root', path])
+        self.shell.write_file(path, text.encode('utf-8'),
+                              owner='root:root')
         self.shell.run(['chmod',
                         '--reference=/opt/phabricator/phabricator/resources/'
                         'sshd/sshd_config.phabricator.example',  # TODO
@@ -836,18 +3466,193 @@ PidFile /var/run/sshd-phabricator.pid
 
         self.shell.run('/usr/sbin/sshd -f /etc/ssh/sshd_config.phabricator')
 
+    def _restart_all(self):
         self.restart()
 
         self.shell.run('ps aux')
 
-    def upgrade(self):
+    # Maps options to the install steps they affect. Apache2 and
+    # PHP are configured from these options, so their steps are
+    # listed here as well. Options not listed affect all steps.
+    def _get_option_steps(self):
+        daemon_user = ['phabricator.daemon-user', 'phabricator.app-dir',
+                       'phabricator.repos-dir', 'phabricator.files-dir',
+                       'phabricator.config', 'phabricator.sudoers']
+        git_user = ['phabricator.git-user', 'phabricator.sudoers',
+                    'phabricator.ssh-hook', 'phabricator.sshd',
+                    'phabricator.config']
+        mysql_user = ['phabricator.mysql-user', 'phabricator.config']
+        return {
+            'app.domain-base': ['apache2.sites', 'phabricator.config'],
+            'app.domain-files': ['phabricator.config'],
+            'app.site.id': ['apache2.sites'],
+            'app.daemon.user.name': daemon_user,
+            'app.git.user.name': git_user,
+            'mysql.user.name': mysql_user,
+            'mysql.user.password': mysql_user,
+
+            # Components are only retrieved when missing, so these
+            # only matter for new installs.
+            'app.components.url-base': [],
+            'app.components.depth': [],
+            'app.components.single-branch': [],
+        }
+
+    # Services to restart once steps with the given ID prefixes
+    # have run.
+    _step_restarts = [
+        ('mysql.', 'mysql'),
+        ('apache2.', 'webserver'),
+        ('php.', 'webserver'),
+        ('phabricator.component.', 'daemon'),
+        ('phabricator.config', 'daemon'),
+        ('phabricator.config', 'webserver'),
+        ('phabricator.storage', 'daemon'),
+    ]
+
+    def _restart_services(self, steps):
+        services = set(service for id in steps
+                       for prefix, service in self._step_restarts
+                       if id.startswith(prefix))
+        if not services:
+            return
+
+        self.log('Restart %s.' % ', '.join(sorted(services)))
+        if 'mysql' in services:
+            self.mysql.restart()
+        if 'daemon' in services:
+            self._restart_daemon()
+        if 'webserver' in services:
+            self.webserver.restart()
+
+    def _add_setup_tasks(self, tasks):
+        # Set up services.
+        self.mysql.add_install_tasks(tasks)
+        self.webserver.add_install_tasks(tasks)
+        self.php.add_install_tasks(tasks)
+
+        # Set up Phabricator.
+        daemon_user = self._config['app.daemon.user.name']
+        git_user = self._config['app.git.user.name']
+        tasks.add('phabricator.supervisor', self._install_supervisor_config)
+        tasks.add('phabricator.mysql-user', self._create_mysql_user,
+                  deps=['mysql'],
+                  inputs=[self._config['mysql.user.name'],
+                          self._config['mysql.user.password']])
+        tasks.add('phabricator.daemon-user', self._create_daemon_user,
+                  deps=['system.packages'],
+                  inputs=daemon_user)
+        tasks.add('phabricator.app-dir', self._create_app_dir,
+                  deps=['phabricator.daemon-user'],
+                  inputs=self._app_path)
+
+        components = []
+        for component_name, path in self._components:
+            id = 'phabricator.component.%s' % component_name
+            tasks.add(id, functools.partial(self._retrieve_component,
+                                            component_name, path),
+                      deps=['phabricator.app-dir'],
+                      inputs=[path,
+                              self._config['app.components.url-base'],
+                              self._config['app.components.depth'],
+                              self._config['app.components.single-branch']])
+            components.append(id)
+
+        tasks.add('phabricator.repos-dir', self._set_up_repos_dir,
+                  deps=['phabricator.daemon-user'],
+                  inputs=self._repos_path)
+        tasks.add('phabricator.files-dir', self._set_up_files_dir,
+                  deps=['phabricator.daemon-user'],
+                  inputs=self._files_path)
+
+        # All Phabricator options are stored in a single file, so
+        # we set them one after another.
+        tasks.add('phabricator.config', self._configure,
+                  deps=components,
+                  inputs=self._settings)
+        tasks.add('phabricator.storage', self._set_up_storage,
+                  deps=['phabricator.config', 'phabricator.mysql-user'])
+
+        # Set up git access.
+        tasks.add('phabricator.git-user', self._create_git_user,
+                  deps=['system.packages'],
+                  inputs=git_user)
+        tasks.add('phabricator.sudoers', self._install_sudoers_file,
+                  deps=['phabricator.git-user'],
+                  inputs=[self._config['app.id'], git_user, daemon_user])
+        tasks.add('phabricator.ssh-hook', self._install_ssh_hook,
+                  inputs=[git_user, self._phabricator_path])
+        tasks.add('phabricator.sshd', self._set_up_sshd,
+                  deps=['phabricator.ssh-hook',
+                        'phabricator.component.phabricator'],
+                  inputs=git_user)
+
+    def add_install_tasks(self, tasks):
+        self._add_setup_tasks(tasks)
+        tasks.add('phabricator.restart', self._restart_all,
+                  deps=tasks.get_ids())
+
+    def install(self, jobs=4):
+        tasks = Tasks(self.log, jobs, self._journal)
+        self.add_install_tasks(tasks)
+        tasks.run()
+        self._mark_config_applied()
+
+    def _get_config_diffs(self):
+        return [('mysql', self.mysql.get_config().get_diff()),
+                ('app', self._config.get_diff())]
+
+    def _mark_config_applied(self):
+        self.mysql.get_config().mark_applied()
+        self._config.mark_applied()
+
+    # Logs options changed since they were last applied.
+    def show_config_changes(self):
+        for name, diff in self._get_config_diffs():
+            for id, (old, new) in sorted(diff.items()):
+                if 'password' in id:
+                    old = new = '***'
+                self.log('%s %s: %s -> %s' % (name, id, repr(old),
+                                              repr(new)))
+
+    # Reruns only the install steps affected by options changed
+    # since they were last applied, and the steps that depend on
+    # them, then restarts only the services these steps affect.
+    def apply(self, jobs=4):
+        mysql_diff, app_diff = (diff for name, diff in
+                                self._get_config_diffs())
+        if not mysql_diff and not app_diff:
+            self.log('No configuration changes to apply.')
+            return
+
+        self.show_config_changes()
+
+        tasks = Tasks(self.log, jobs, self._journal)
+        self._add_setup_tasks(tasks)
+
+        option_steps = self._get_option_steps()
+        steps = set(self.mysql.get_affected_steps(mysql_diff))
+        for id in app_diff:
+            steps.update(option_steps.get(id, tasks.get_ids()))
+
+        steps = tasks.get_dependents(steps)
+        tasks.add('phabricator.restart-services',
+                  functools.partial(self._restart_services, steps),
+                  deps=tasks.get_ids())
+        tasks.run(steps + ['phabricator.restart-services'])
+        self._mark_config_applied()
+
+    def upgrade(self, jobs=4):
         # TODO
         # https://secure.phabricator.com/book/phabricator/article/upgrading/
         self.log("Upgrade phabricator components.")
+        tasks = Tasks(self.log, jobs)
         for component_name, path in self._components:
-            self.shell.run('cd %s && '
-                           'git pull' % path,
-                           user=self._config['app.daemon.user.name'])
+            tasks.add('phabricator.component.%s' % component_name,
+                      functools.partial(
+                          self._fetcher.update, component_name, path,
+                          user=self._config['app.daemon.user.name']))
+        tasks.run()
 
         raise Error('Upgrading Phabricator is not supported yet.')
 
@@ -883,7 +3688,330 @@ PidFile /var/run/sshd-phabricator.pid
         self._stop_daemon()
         self.mysql.stop()
 
-    def backup(self):
+    def _get_backup_paths(self, dir):
+        return (os.path.join(dir, 'db.sql.zst'),
+                os.path.join(dir, 'data.tar.zst'))
+
+    def _get_databases_dir(self, dir):
+        return os.path.join(dir, 'databases')
+
+    # Uses the same options as 'bin/storage dump', so that binary
+    # columns and 4-byte UTF-8 characters survive the dump.
+    def _dump_database(self, dir, database):
+        path = os.path.join(dir, '%s.sql.zst' % database)
+        self.log('Dump database %s to %s.' % (database, path))
+        with open(path + '.tmp', 'wb') as f:
+            meter = TransferMeter(f, self.log, path)
+            self.shell.run(_get_pipeline_command(
+                               [self.mysql.get_dump_command(),
+                                '--hex-blob',
+                                '--default-character-set=utf8mb4',
+                                '--single-transaction', '--quick',
+                                '--add-drop-database', '--databases',
+                                database],
+                               ['zstd', '-c']),
+                           output=meter)
+            meter.report()
+        os.rename(path + '.tmp', path)
+
+    # Dumps every Phabricator database to its own file, running
+    # up to the given number of dumps at once. The dumps are made
+    # in a new directory that then replaces the given one, so that
+    # previous dumps are kept until all new ones are complete and
+    # dumps of databases that no longer exist do not remain.
+    #
+    # Every dump is a transaction of its own, so each database is
+    # consistent in itself, but writes made while the dumps run may
+    # be caught in some databases and not in others. Unlike with a
+    # single dump, daemons and the web server are thus to be stopped
+    # to get a backup consistent across databases.
+    def dump_databases(self, dir, jobs=4):
+        new_dir = dir + '.tmp'
+        shutil.rmtree(new_dir, ignore_errors=True)
+        os.makedirs(new_dir)
+
+        tasks = Tasks(self.log, jobs)
+        for database in self.mysql.get_databases(r'phabricator\_%'):
+            tasks.add(database, functools.partial(self._dump_database,
+                                                  new_dir, database))
+        tasks.run()
+
+        shutil.rmtree(dir, ignore_errors=True)
+        os.rename(new_dir, dir)
+
+    def _restore_database(self, path):
+        self.log('Restore database from %s.' % path)
+
+        # Checks are redundant for consistent dumps.
+        settings = ('SET SESSION unique_checks = 0, '
+                    'foreign_key_checks = 0;')
+        with open(path, 'rb') as f:
+            meter = TransferMeter(f, self.log, path)
+            self.shell.run(_get_pipeline_command(
+                               ["{ echo '%s'; zstd -d -c; }" % settings],
+                               [self.mysql.get_client_command()]),
+                           input=meter)
+            meter.report()
+
+    # Restores databases dumped with dump_databases(), running up to
+    # the given number of restores at once. For the time of
+    # restoring, the log is not flushed on every commit.
+    def restore_databases(self, dir, jobs=4):
+        paths = sorted(os.path.join(dir, name) for name in os.listdir(dir)
+                       if name.endswith('.sql.zst'))
+
+        flush_id = 'innodb_flush_log_at_trx_commit'
+        flush_value = self.mysql.get_global_variable(flush_id)
+        self.mysql.set_global_variable(flush_id, 2)
+        try:
+            tasks = Tasks(self.log, jobs)
+            for path in paths:
+                tasks.add(path, functools.partial(self._restore_database,
+                                                  path))
+            tasks.run()
+        finally:
+            self.mysql.set_global_variable(flush_id, flush_value)
+
+    # Streams the database dump and the repositories and files
+    # directories through a multi-threaded compressor into the given
+    # local directory, without storing any intermediate copies. The
+    # dump in the other format, if any, is removed, so that restoring
+    # does not pick it up.
+    def _stream_backup(self, dir, jobs):
+        os.makedirs(dir, exist_ok=True)
+        db_path, data_path = self._get_backup_paths(dir)
+        compress = ['zstd', '-T0', '-c']
+
+        if jobs:
+            self.dump_databases(self._get_databases_dir(dir), jobs)
+            if os.path.exists(db_path):
+                os.remove(db_path)
+        else:
+            self.log('Dump database to %s.' % db_path)
+            with open(db_path + '.tmp', 'wb') as f:
+                meter = TransferMeter(f, self.log, db_path)
+                self._run_storage_pipeline(['dump'], [compress],
+                                           output=meter)
+                meter.report()
+            os.rename(db_path + '.tmp', db_path)
+            shutil.rmtree(self._get_databases_dir(dir), ignore_errors=True)
+
+        self.log('Archive repositories and files to %s.' % data_path)
+        with open(data_path + '.tmp', 'wb') as f:
+            meter = TransferMeter(f, self.log, data_path)
+            self.shell.run(_get_pipeline_command(
+                               ['tar', '--create', '--file=-',
+                                '--directory=/',
+                                self._repos_path.lstrip('/'),
+                                self._files_path.lstrip('/')],
+                               compress),
+                           output=meter)
+            meter.report()
+        os.rename(data_path + '.tmp', data_path)
+
+    def _stream_restore(self, dir, jobs):
+        db_path, data_path = self._get_backup_paths(dir)
+        databases_dir = self._get_databases_dir(dir)
+
+        self.log('Restore repositories and files from %s.' % data_path)
+        with open(data_path, 'rb') as f:
+            meter = TransferMeter(f, self.log, data_path)
+            self.shell.run(_get_pipeline_command(
+                               ['zstd', '-d', '-c'],
+                               ['tar', '--extract', '--same-owner',
+                                '--same-permissions', '--file=-',
+                                '--directory=/']),
+                           input=meter)
+            meter.report()
+
+        if os.path.exists(databases_dir):
+            self.restore_databases(databases_dir, jobs or 4)
+            return
+
+        self.log('Restore database from %s.' % db_path)
+        with open(db_path, 'rb') as f:
+            meter = TransferMeter(f, self.log, db_path)
+            self.shell.run(_get_pipeline_command(
+                               ['zstd', '-d', '-c'],
+                               [self.mysql.get_client_command()]),
+                           input=meter)
+            meter.report()
+
+    # Lists directories and files in the repositories and files
+    # directories as manifest entries without hashes.
+    def _list_data_entries(self):
+        listing = io.BytesIO()
+        self.shell.run(['find', self._repos_path, self._files_path,
+                        r'\(', '-type', 'd', '-o', '-type', 'f', r'\)',
+                        '-printf', r"'%y %m %u:%g %s %T@ %p\0'"],
+                       output=listing)
+
+        entries = []
+        for record in listing.getvalue().split(b'\0'):
+            if not record:
+                continue
+
+            type, mode, owner, size, mtime, path = (
+                record.decode('utf-8').split(' ', 5))
+            entries.append({'type': type, 'mode': int(mode, 8),
+                            'owner': owner, 'size': int(size),
+                            'mtime': mtime, 'path': path, 'hash': None})
+        return entries
+
+    # With NUL-terminated records, sha256sum does not escape names
+    # containing backslashes and newlines.
+    def _hash_files(self, paths):
+        hashes = io.BytesIO()
+        self.shell.run(['xargs', '-0', '-r', 'sha256sum', '--zero', '--'],
+                       input=b'\0'.join(p.encode('utf-8') for p in paths),
+                       output=hashes)
+
+        result = dict()
+        for record in hashes.getvalue().decode('utf-8').split('\0'):
+            if record:
+                hash, path = record.split('  ', 1)
+                result[path] = hash
+        return result
+
+    # Transfers files to the store. Returns their hashes as
+    # computed on receipt.
+    def _transfer_files(self, store, paths):
+        def write(writer):
+            self.shell.run(['tar', '--create', '--file=-', '--directory=/',
+                            '--null', '--files-from=-'],
+                           input=b'\0'.join(p.lstrip('/').encode('utf-8')
+                                            for p in paths),
+                           output=writer)
+
+        hashes = dict()
+        pipe = _Pipe(write)
+        try:
+            with tarfile.open(fileobj=pipe.reader, mode='r|') as tar:
+                for info in tar:
+                    if info.isfile():
+                        hashes['/' + info.name] = store.add_chunk(
+                            tar.extractfile(info))
+        finally:
+            pipe.close()
+        return hashes
+
+    # Makes an incremental snapshot of the database and the
+    # repositories and files directories in the local chunk store.
+    # Only files whose size or modification time have changed since
+    # the last snapshot are hashed, and only contents missing in the
+    # store are transferred.
+    def backup_snapshot(self, dir):
+        store = ChunkStore(dir)
+        previous = dict()
+        ids = store.get_snapshot_ids()
+        if ids:
+            for entry in store.load_snapshot(ids[-1])['entries']:
+                previous[entry['path']] = entry
+
+        self.log('Scan repositories and files.')
+        entries = self._list_data_entries()
+        files = [entry for entry in entries if entry['type'] == 'f']
+        for entry in files:
+            old = previous.get(entry['path'])
+            if (old and old['size'] == entry['size'] and
+                    old['mtime'] == entry['mtime']):
+                entry['hash'] = old['hash']
+
+        changed = [entry['path'] for entry in files if not entry['hash']]
+        self.log('Hash %d changed files of %d.' % (len(changed), len(files)))
+        hashes = self._hash_files(changed) if changed else dict()
+
+        # Files with the same new contents are transferred once.
+        missing = dict()
+        for path, hash in hashes.items():
+            if not store.has_chunk(hash):
+                missing.setdefault(hash, path)
+
+        self.log('Transfer %d new files.' % len(missing))
+        if missing:
+            hashes.update(self._transfer_files(store,
+                                               list(missing.values())))
+
+        for entry in files:
+            entry['hash'] = entry['hash'] or hashes[entry['path']]
+
+        self.log('Dump database.')
+        pipe = _Pipe(lambda writer: self._run_storage_pipeline(
+                         ['dump'], [['zstd', '-c']], output=writer))
+        try:
+            database = store.add_chunk(pipe.reader)
+        finally:
+            pipe.close()
+
+        id = store.save_snapshot({'database': database, 'entries': entries})
+        self.log('Saved snapshot %s.' % id)
+        return id
+
+    def _write_snapshot_archive(self, store, entries, writer):
+        with tarfile.open(fileobj=writer, mode='w|') as tar:
+            for entry in entries:
+                info = tarfile.TarInfo(entry['path'].lstrip('/'))
+                info.mode = entry['mode']
+                info.mtime = int(float(entry['mtime']))
+                info.uname, info.gname = entry['owner'].split(':')
+                if entry['type'] == 'd':
+                    info.type = tarfile.DIRTYPE
+                    tar.addfile(info)
+                    continue
+
+                info.size = store.get_chunk_size(entry['hash'])
+                with store.open_chunk(entry['hash']) as f:
+                    tar.addfile(info, f)
+
+    # Rebuilds the database and the repositories and files
+    # directories from a snapshot. Restores the latest snapshot
+    # unless specified otherwise.
+    def restore_snapshot(self, dir, id=None):
+        store = ChunkStore(dir)
+        if not id:
+            ids = store.get_snapshot_ids()
+            if not ids:
+                raise Error('No snapshots to restore.')
+            id = ids[-1]
+        manifest = store.load_snapshot(id)
+
+        # TODO: Stop daemons before restoring.
+        self._run_storage_as_root(['destroy'])
+
+        self.log('Restore repositories and files from snapshot %s.' % id)
+        self.shell.run(['rm', '-rf', self._repos_path, self._files_path])
+        pipe = _Pipe(functools.partial(self._write_snapshot_archive,
+                                       store, manifest['entries']))
+        try:
+            self.shell.run(['tar', '--extract', '--same-owner',
+                            '--same-permissions', '--file=-',
+                            '--directory=/'],
+                           input=pipe.reader)
+        finally:
+            pipe.close()
+
+        self.log('Restore database from snapshot %s.' % id)
+        with store.open_chunk(manifest['database']) as f:
+            self.shell.run(_get_pipeline_command(
+                               ['zstd', '-d', '-c'],
+                               [self.mysql.get_client_command()]),
+                           input=f)
+
+        self._set_up_repos_dir()
+        self._set_up_files_dir()
+
+        self._upgrade_storage()
+
+    # With a local directory specified, the backup is streamed to
+    # that directory instead of being stored in the container. With
+    # a number of jobs, databases are dumped separately and in
+    # parallel, which, unlike a single dump, is only consistent
+    # across databases if nothing writes to them meanwhile.
+    def backup(self, dir=None, jobs=None):
+        if dir:
+            self._stream_backup(dir, jobs)
+            return
+
         self.shell.run(['rm', '-f', '/root/db.sql', '/root/backup.tgz'])
         self._run_storage(['dump', '>/root/db.sql'])
         self.shell.run(['tar', 'czf', '/root/backup.tgz',
@@ -891,15 +4019,16 @@ PidFile /var/run/sshd-phabricator.pid
                         self._repos_path,
                         self._files_path])
 
-    def restore(self):
+    def restore(self, dir=None, jobs=None):
         # TODO: Stop daemons before restoring.
         self._run_storage_as_root(['destroy'])
 
-        self.shell.run(['tar', 'xzf', '/root/backup.tgz', '-C', '/'])
-
-        self.shell.run(
-            'mysql --user=root --password=%s '
-            '</root/db.sql' % self.mysql.get_config()['root.password'])
+        if dir:
+            self._stream_restore(dir, jobs)
+        else:
+            self.shell.run(['tar', 'xzf', '/root/backup.tgz', '-C', '/'])
+            self.shell.run('%s </root/db.sql' % (
+                               self.mysql.get_client_command()))
 
         self._set_up_repos_dir()
         self._set_up_files_dir()
@@ -908,54 +4037,251 @@ PidFile /var/run/sshd-phabricator.pid
 
 
 class MyDockerPhabricator(Phabricator):
-    def __init__(self, container_name, mysql_config, app_config):
-        local_shell = LocalShell(Logger())
-
-        docker_shell = DockerContainerShell(
-            container_name=container_name,
-            shell=local_shell)
-
-        system = Ubuntu(docker_shell)
+    # A custom shell, e.g., a RecordingShell, can be used instead
+    # of accessing the container. With a Docker socket path, the
+    # container is accessed through the Docker Engine API. With an
+    # SSH destination, [user@]host[:port], the host is accessed
+    # directly instead of a container. With the base image cache
+    # enabled, the container is committed as an image once system
+    # packages are installed.
+    def __init__(self, container_name, mysql_config, app_config,
+                 session=False, mirror_cache_path=None, shell=None,
+                 log=None, journal=None, docker_socket=None,
+                 ssh_destination=None, base_image_cache=False):
+        local_shell = LocalShell(log or Logger())
+
+        image_cache = None
+        if base_image_cache and not shell and not ssh_destination:
+            image_cache = BaseImageCache(local_shell, container_name)
+
+        if not shell and ssh_destination:
+            destination = urllib.parse.urlsplit('//' + ssh_destination)
+            shell = RemoteShell(destination.hostname, local_shell.log,
+                                port=destination.port or 22,
+                                username=destination.username or 'root')
+
+        if not shell and docker_socket:
+            shell = DockerEngineShell(container_name, local_shell.log,
+                                      socket_path=docker_socket)
+
+        if not shell:
+            shell = DockerContainerShell(
+                container_name=container_name,
+                shell=local_shell,
+                session=session)
+
+        system = Ubuntu(shell, image_cache=image_cache)
 
         mysql = MariaDB(system, config=mysql_config)
 
+        mirror_cache = None
+        if mirror_cache_path:
+            mirror_cache = GitMirrorCache(local_shell, mirror_cache_path)
+
         super().__init__(
             mysql=mysql,
             webserver=Apache2(system),
             php=PHP(system),
-            config=app_config)
+            config=app_config,
+            mirror_cache=mirror_cache,
+            journal=journal)
 
 
-def deploy(container_name):
-    if len(sys.argv) != 2:
-        sys.exit('Usage: wheelcode.py <action>')
+# Performs the action on a container with configs in the given
+# directory. Relative paths of plan and trace files are relative
+# to that directory as well.
+def _deploy_instance(container_name, config_dir, args, writer):
+    sink = TraceSink() if args.trace else None
+    log = Logger(sink, writer)
 
-    action = sys.argv[1]
+    shell = None
+    if args.plan:
+        model = dict()
+        if args.plan_model:
+            with open(args.plan_model, 'rt') as f:
+                model = json.load(f)
+        shell = RecordingShell(log, model)
+
+    action = args.action
 
     # Create default configs.
     configs = {'config-phabricator.mysql': Config(),
                'config-phabricator.app': Config()}
 
-    # Load existing configs.
+    # Load existing configs, along with the values last
+    # applied.
     for id, config in configs.items():
+        path = os.path.join(config_dir, id)
+        try:
+            config.load(path)
+        except FileNotFoundError:
+            pass
+
         try:
-            config.load(id)
+            config.load_applied(path + '.applied')
         except FileNotFoundError:
             pass
 
+    # Completed steps are journaled next to the configs, so
+    # that failed installs can be resumed. Planning does not
+    # use the journal.
+    journal = None
+    if not shell:
+        journal = StepJournal(os.path.join(config_dir,
+                                           'config-phabricator.journal'))
+        if args.fresh:
+            journal.clear()
+
     # Create app object.
     phabricator = MyDockerPhabricator(
         container_name=container_name,
         mysql_config=configs['config-phabricator.mysql'],
-        app_config=configs['config-phabricator.app'])
-
-    # Update configs before any further actions.
-    for id, config in configs.items():
-        config.save(id)
+        app_config=configs['config-phabricator.app'],
+        session=args.session,
+        mirror_cache_path=None if shell else args.mirror_cache,
+        shell=shell,
+        log=log,
+        journal=journal,
+        docker_socket=args.docker_socket,
+        ssh_destination=args.ssh,
+        base_image_cache=args.cache_base_image)
+
+    # Update configs before any further actions. Planning does
+    # not change anything.
+    if not shell:
+        for id, config in configs.items():
+            config.save(os.path.join(config_dir, id))
 
     # Perform whatever is the requested action, e.g.,
-    # 'phabricator.install()'.
-    eval(action)
+    # 'phabricator.install()' or 'phabricator.apply()'.
+    try:
+        if journal and journal.set_target(phabricator.shell.get_target_id()):
+            log('Forget steps journaled for another target.')
+
+        eval(action)
+
+        if not shell:
+            for id, config in configs.items():
+                config.save_applied(os.path.join(config_dir, id) +
+                                    '.applied')
+    finally:
+        phabricator.shell.close()
+        if shell:
+            shell.save_plan(os.path.join(config_dir, args.plan))
+        if sink:
+            log.end_spans()
+            sink.save(os.path.join(config_dir, args.trace))
+
+
+# Performs the action on all containers of the inventory, which
+# maps names of containers to their config directories. Logs of
+# the instances are written to their config directories.
+def _deploy_fleet(args):
+    inventory = Config()
+    inventory.load(args.inventory)
+    log = Logger()
+
+    def deploy_instance(container_name, config_dir):
+        start = time.monotonic()
+        writer = None
+        try:
+            writer = LogWriter(os.path.join(config_dir,
+                                            args.log_file or 'deploy.log'),
+                               echo=False)
+            _deploy_instance(container_name, config_dir, args, writer)
+            error = None
+        except Exception as e:
+            error = e
+            if writer:
+                writer.write(sys.stderr, 'Error: %s\n' % e)
+        finally:
+            if writer:
+                writer.close()
+        return time.monotonic() - start, error
+
+    log('Deploy %d instances, up to %d at once.' % (
+            len(list(inventory)), args.fleet_jobs))
+    results = dict()
+    with concurrent.futures.ThreadPoolExecutor(args.fleet_jobs) as executor:
+        futures = {executor.submit(deploy_instance, container_name,
+                                   config_dir): container_name
+                   for container_name, config_dir in inventory}
+        for future in concurrent.futures.as_completed(futures):
+            container_name = futures[future]
+            elapsed, error = results[container_name] = future.result()
+            log('%s: %s in %.1fs.' % (container_name,
+                                      'failed' if error else 'done',
+                                      elapsed))
+
+    log('Summary:')
+    failures = 0
+    for container_name, (elapsed, error) in sorted(results.items()):
+        status = 'ok'
+        if error:
+            failures += 1
+            status = 'FAILED: %s' % str(error).split('\n')[0]
+        log('%-24s %8.1fs  %s' % (container_name, elapsed, status))
+
+    if failures:
+        raise Error('%d of %d instances failed.' % (failures, len(results)))
+
+
+def deploy(container_name):
+    parser = argparse.ArgumentParser(prog='wheelcode.py')
+    parser.add_argument('--session', action='store_true',
+                        help='run all commands in a single container shell')
+    parser.add_argument('--docker-socket', metavar='PATH', nargs='?',
+                        const='/var/run/docker.sock',
+                        help='talk to the Docker Engine API at PATH '
+                             '(%(const)s by default) instead of running '
+                             'the docker command')
+    parser.add_argument('--ssh', metavar='[USER@]HOST[:PORT]',
+                        help='install on the host over SSH instead of '
+                             'in a container')
+    parser.add_argument('--mirror-cache', metavar='DIR',
+                        help='keep mirrors of git repositories in DIR')
+    parser.add_argument('--cache-base-image', action='store_true',
+                        help='commit the container as an image once '
+                             'system packages are installed, for '
+                             'create_container.sh to start from')
+    parser.add_argument('--plan', metavar='FILE',
+                        help='do not access the container; instead, '
+                             'save the plan of the action to FILE')
+    parser.add_argument('--plan-model', metavar='FILE',
+                        help='answer queries in the plan mode from the '
+                             'model in FILE')
+    parser.add_argument('--trace', metavar='FILE',
+                        help='save timing spans to FILE, as JSON lines '
+                             'for the .jsonl extension and as a Chrome '
+                             'trace otherwise')
+    parser.add_argument('--fresh', action='store_true',
+                        help='forget steps completed in previous runs '
+                             'and run all of them')
+    parser.add_argument('--log-file', metavar='FILE',
+                        help='also write the log to FILE, rotating it '
+                             'as it grows')
+    parser.add_argument('--inventory', metavar='FILE',
+                        help='perform the action on all containers '
+                             'listed in FILE, which maps their names '
+                             'to config directories')
+    parser.add_argument('--fleet-jobs', metavar='N', type=int, default=4,
+                        help='deploy up to N containers at once')
+    parser.add_argument('action', help="e.g., 'phabricator.install()'")
+    args = parser.parse_args()
+
+    if args.inventory and args.ssh:
+        parser.error('--ssh cannot be used with --inventory')
+
+    if args.inventory:
+        _deploy_fleet(args)
+        return
+
+    # Make sure all output is written out, whatever happens.
+    writer = LogWriter(args.log_file)
+    try:
+        _deploy_instance(container_name, '', args, writer)
+    finally:
+        writer.close()
 
 
 def main():